@@ -0,0 +1,238 @@
+import argparse
+import json
+import os
+import platform
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "emulator"))
+
+from dataclasses import replace
+
+from virtual_machine import VirtualMachine, VMState, MemoryLayout
+from compiler import BlockCompiler
+from profiler import Profiler
+from programs import PROGRAMS, Program
+
+try:
+    from batch import BatchMachine
+except ImportError:
+    BatchMachine = None
+
+
+BATCH_LANES = 64
+BATCH_STEPS = 2000
+
+
+def _interpreter(skip_waits: bool):
+    def run(data: bytes, cycles: int) -> float:
+        vm = VirtualMachine(list(data))
+        begin = time.perf_counter()
+        vm.run(cycles, skip_waits)
+        return time.perf_counter() - begin
+
+    return run
+
+
+def _compiled(skip_waits: bool):
+    def run(data: bytes, cycles: int) -> float:
+        vm = VirtualMachine(list(data))
+        compiler = BlockCompiler(vm)
+        begin = time.perf_counter()
+        compiler.run(cycles, skip_waits)
+        return time.perf_counter() - begin
+
+    return run
+
+
+def _batch(data: bytes, cycles: int) -> float:
+    batch = BatchMachine(data, BATCH_LANES)
+    begin = time.perf_counter()
+    batch.run(cycles)
+    return time.perf_counter() - begin
+
+
+ENGINES = {
+    "interpreter": (_interpreter(False), 1),
+    "interpreter-skip-waits": (_interpreter(True), 1),
+    "compiled": (_compiled(False), 1),
+    "compiled-skip-waits": (_compiled(True), 1),
+}
+if BatchMachine is not None:
+    ENGINES["batch"] = (_batch, BATCH_LANES)
+
+
+def count_instructions(data: bytes, cycles: int) -> int:
+    vm = VirtualMachine(list(data))
+    profiler = Profiler()
+    profiler.attach(vm)
+    vm.run(cycles)
+    return sum(profiler.pc_hits)
+
+
+def run_benchmark(program: Program, engine: str, repeat: int) -> dict:
+    func, lanes = ENGINES[engine]
+    data = program.image
+    cycles = program.cycles if lanes == 1 else min(program.cycles, BATCH_STEPS)
+    instructions = count_instructions(data, cycles) * lanes
+    seconds = min(func(data, cycles) for _ in range(repeat))
+    return {
+        "program": program.name,
+        "engine": engine,
+        "cycles": cycles * lanes,
+        "instructions": instructions,
+        "seconds": seconds,
+        "cycles_per_second": cycles * lanes / seconds,
+        "instructions_per_second": instructions / seconds,
+    }
+
+
+def run(args) -> int:
+    programs = [p for p in PROGRAMS if not args.program or p.name in args.program]
+    engines = [e for e in ENGINES if not args.engine or e in args.engine]
+    results = []
+    for program in programs:
+        for engine in engines:
+            result = run_benchmark(program, engine, args.repeat)
+            results.append(result)
+            print(
+                f"{program.name:<12} {engine:<24}"
+                f" {result['instructions_per_second']:>14,.0f} inst/s"
+                f" {result['cycles_per_second']:>16,.0f} cyc/s"
+            )
+    if args.output is not None:
+        with open(args.output, "w") as f:
+            json.dump(
+                {
+                    "python": platform.python_version(),
+                    "machine": platform.machine(),
+                    "results": results,
+                },
+                f,
+                indent=2,
+            )
+    return 0
+
+
+def random_image(rng: random.Random) -> bytes:
+    # Random bytes over the program area, zeros elsewhere.
+    size = (MemoryLayout.PROGRAM_END + 1) // 2
+    return bytes(rng.randrange(0x100) for _ in range(size)) + bytes(0x80 - size)
+
+
+def final_states(image: bytes, cycles: int) -> dict[str, VMState] | None:
+    # The state each engine ends in after cycles, or None if the program
+    # faults on the interpreter. last_inst is not tracked by every engine.
+    states = {}
+    vm = VirtualMachine(list(image))
+    try:
+        vm.run(cycles)
+    except AssertionError:
+        return None
+    states["interpreter"] = replace(vm.snapshot(), last_inst="")
+    vm = VirtualMachine(list(image))
+    try:
+        BlockCompiler(vm).run(cycles)
+    except AssertionError:
+        pass
+    states["compiled"] = replace(vm.snapshot(), last_inst="")
+    return states
+
+
+def batch_states(images: list[bytes], cycles: int) -> list[VMState]:
+    # One lane per image; a lane that faults keeps the state it faulted in.
+    batch = BatchMachine(bytes(0x80), len(images))
+    for lane, image in enumerate(images):
+        batch.mem[lane] = VirtualMachine(list(image)).mem
+    batch.run(cycles)
+    return [
+        replace(batch.export(lane).snapshot(), last_inst="")
+        for lane in range(len(images))
+    ]
+
+
+def check(args) -> int:
+    rng = random.Random(args.seed)
+    images = []
+    states = []
+    skipped = 0
+    while len(images) < args.count:
+        image = random_image(rng)
+        final = final_states(image, args.cycles)
+        if final is None:
+            skipped += 1
+            continue
+        images.append(image)
+        states.append(final)
+    if BatchMachine is not None:
+        for final, state in zip(states, batch_states(images, args.cycles)):
+            final["batch"] = state
+
+    mismatches = 0
+    for i, (image, final) in enumerate(zip(images, states)):
+        expected = final.pop("interpreter")
+        for engine, state in final.items():
+            if state != expected:
+                mismatches += 1
+                program = image[: (MemoryLayout.PROGRAM_END + 1) // 2].hex()
+                print(f"image {i} {program}: {engine} differs from interpreter")
+    engines = ", ".join(["interpreter", *states[0]]) if states else "interpreter"
+    print(
+        f"{len(images)} images ({skipped} faulting skipped) on {engines}:"
+        f" {mismatches} mismatches"
+    )
+    return 1 if mismatches else 0
+
+
+def compare(args) -> int:
+    with open(args.baseline, "r") as f:
+        baseline = json.load(f)["results"]
+    with open(args.current, "r") as f:
+        current = json.load(f)["results"]
+
+    previous = {(r["program"], r["engine"]): r for r in baseline}
+    regressions = 0
+    for result in current:
+        base = previous.get((result["program"], result["engine"]))
+        if base is None:
+            continue
+        ratio = result["instructions_per_second"] / base["instructions_per_second"]
+        status = "ok"
+        if ratio < 1 - args.threshold:
+            status = "REGRESSION"
+            regressions += 1
+        print(
+            f"{result['program']:<12} {result['engine']:<24}"
+            f" {base['instructions_per_second']:>14,.0f}"
+            f" -> {result['instructions_per_second']:>14,.0f}"
+            f" {ratio:>7.2f}x  {status}"
+        )
+    return 1 if regressions else 0
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    run_parser = commands.add_parser("run")
+    run_parser.add_argument("-o", "--output")
+    run_parser.add_argument("-r", "--repeat", type=int, default=3)
+    run_parser.add_argument("-p", "--program", nargs="*")
+    run_parser.add_argument("-e", "--engine", nargs="*")
+    run_parser.set_defaults(func=run)
+
+    compare_parser = commands.add_parser("compare")
+    compare_parser.add_argument("baseline")
+    compare_parser.add_argument("current")
+    compare_parser.add_argument("-t", "--threshold", type=float, default=0.1)
+    compare_parser.set_defaults(func=compare)
+
+    check_parser = commands.add_parser("check")
+    check_parser.add_argument("-n", "--count", type=int, default=200)
+    check_parser.add_argument("-c", "--cycles", type=int, default=2000)
+    check_parser.add_argument("-s", "--seed", type=int, default=0)
+    check_parser.set_defaults(func=check)
+
+    args = parser.parse_args()
+    sys.exit(args.func(args))
@@ -0,0 +1,60 @@
+from dataclasses import dataclass
+
+
+@dataclass(frozen=True)
+class Program:
+    name: str
+    code: dict[int, str]
+    cycles: int = 100_000
+
+    @property
+    def image(self) -> bytes:
+        nibbles = [0] * 0x100
+        for addr, code in self.code.items():
+            for digit in code.replace(" ", ""):
+                nibbles[addr] = int(digit, 16)
+                addr += 1
+        return bytes((nibbles[i] << 4) | nibbles[i + 1] for i in range(0, 0x100, 2))
+
+
+PROGRAMS = [
+    # Arithmetic loop over the data area: ST/ADD/SUB/LD with a moving Y.
+    Program(
+        "arithmetic",
+        {
+            0x00: "A0 85 4 6 7 93 B1 5 F04",
+        },
+    ),
+    # Nested subroutines that save and restore registers on the stack.
+    Program(
+        "stack",
+        {
+            0x00: "81 F6010",
+            0x07: "F02",
+            0x10: "F62 F66 A7 91 F6030 F67 F63 F61",
+            0x30: "F64 F65 F61",
+        },
+    ),
+    # Service calls that run without a wait or console output.
+    Program(
+        "scall",
+        {
+            0x00: "E4 E6 E1 E2 E5 ED A3 E1 81 F00",
+        },
+    ),
+    # Binary LED counter that waits between updates, as demo programs do.
+    Program(
+        "wait",
+        {
+            0x00: "80 91 1 E1 B1 EC F02",
+        },
+        cycles=500_000,
+    ),
+    # Key polling loop with no key down, where interactive programs idle.
+    Program(
+        "ink",
+        {
+            0x00: "0 F00 1 81 F00",
+        },
+    ),
+]
@@ -1,15 +1,197 @@
 import argparse
-from virtual_machine import VirtualMachine
-from monitor import VirtualMachineMonitor
+import json
+import time
+from virtual_machine import VirtualMachine, Register
+from rewind import RewindBuffer
+from profiler import Profiler
+from debugger import Debugger
+from events import format_event
+from scheduler import Scheduler
+from trace import TraceRecorder
+from inputscript import InputPlayer, InputRecorder, load_script
+from loader import ImageCache, load_program
+
+
+def parse_breakpoint(value: str) -> int:
+    pc = int(value, 16)
+    if not 0x00 <= pc <= 0xFF:
+        raise argparse.ArgumentTypeError(f"address must be 00 to FF: {value}")
+    return pc
+
+
+def parse_watch(value: str) -> tuple[int, int, str]:
+    span, _, mode = value.partition(":")
+    begin, _, end = span.partition("-")
+    begin, end, mode = int(begin, 16), int(end or begin, 16), mode or "w"
+    if not 0x00 <= begin <= end <= 0xFF:
+        raise argparse.ArgumentTypeError(f"invalid address range: {value}")
+    if not set(mode) <= {"r", "w"}:
+        raise argparse.ArgumentTypeError(f"mode must be r, w or rw: {value}")
+    if "r" in mode and not Debugger.can_watch_reads(begin, end):
+        raise argparse.ArgumentTypeError(
+            f"reads of {Debugger.SYSTEM_BEGIN:02X}-{Debugger.SYSTEM_END:02X}"
+            f" cannot be watched: {value}"
+        )
+    return begin, end, mode
+
+
+def parse_hz(value: str) -> int:
+    hz = int(value)
+    if not 0 < hz <= VirtualMachine.MAX_HZ:
+        raise argparse.ArgumentTypeError(
+            f"clock must be 1 to {VirtualMachine.MAX_HZ} Hz: {value}"
+        )
+    return hz
+
+
+def parse_speed(value: str) -> float | None:
+    if value == "turbo":
+        return None
+    speed = float(value)
+    if not speed > 0:
+        raise argparse.ArgumentTypeError(f"speed must be positive: {value}")
+    return speed
+
+
+def parse_until(value: str) -> tuple[str, int]:
+    name, _, target = value.partition("=")
+    if name not in ("numeric_led", "binary_led") or not target:
+        raise argparse.ArgumentTypeError(f"invalid stop condition: {value}")
+    return name, int(target, 16)
+
+
+def run_headless(
+    vm: VirtualMachine, debugger: Debugger, player: InputPlayer, args
+) -> dict:
+    conditions = [
+        (getattr(VirtualMachine, f"get_{name}"), target) for name, target in args.until
+    ]
+
+    def predicate(vm: VirtualMachine) -> bool:
+        return any(get(vm) == target for get, target in conditions)
+
+    deadline = None if args.timeout is None else time.monotonic() + args.timeout
+    begin = time.perf_counter()
+    result = player.run(
+        vm,
+        args.cycles,
+        args.skip_waits,
+        predicate if conditions else None,
+        1 if conditions else 1000,
+        deadline,
+    )
+    wall_time = time.perf_counter() - begin
+    events = vm.events.drain()
+
+    return {
+        "image": args.input,
+        "cycles": result.cycles,
+        "reason": result.reason.name,
+        "pc": result.pc,
+        "hit": None if debugger.hit is None else debugger.hit.kind.name,
+        "registers": {register.name: vm.get_reg(register) for register in Register},
+        "numeric_led": vm.get_numeric_led(),
+        "binary_led": vm.get_binary_led(),
+        "last_inst": vm.last_inst,
+        "events": [format_event(event) for event in events],
+        "events_dropped": vm.events.dropped,
+        "wall_time": wall_time,
+    }
+
+
+def format_result(result: dict) -> str:
+    stopped = f"stopped: {result['reason']} at PC {result['pc']:02X}"
+    if result["hit"] is not None:
+        stopped += f" ({result['hit']})"
+    registers = " ".join(
+        f"{name}={value:X}" for name, value in result["registers"].items()
+    )
+    lines = [
+        stopped,
+        f"cycles: {result['cycles']} in {result['wall_time']:.3f} s",
+        f"last: {result['last_inst']}",
+        f"numeric led: {result['numeric_led']:X}",
+        f"binary led: {result['binary_led']:07b}",
+        f"registers: {registers}",
+        *result["events"],
+    ]
+    if result["events_dropped"]:
+        lines.append(f"({result['events_dropped']} earlier events dropped)")
+    return "\n".join(lines)
+
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument("-i", "--input", required=True)
+    parser.add_argument("--rewind-mb", type=int, default=64)
+    parser.add_argument("--profile", action="store_true")
+    parser.add_argument(
+        "-b", "--breakpoint", type=parse_breakpoint, action="append", default=[]
+    )
+    parser.add_argument("-w", "--watch", type=parse_watch, action="append", default=[])
+    parser.add_argument("--hz", type=parse_hz, default=VirtualMachine.HZ)
+    parser.add_argument("--speed", type=parse_speed, default=1.0)
+    parser.add_argument("--headless", action="store_true")
+    parser.add_argument("-n", "--cycles", type=int, default=1_000_000)
+    parser.add_argument("--timeout", type=float)
+    parser.add_argument("--until", type=parse_until, action="append", default=[])
+    parser.add_argument("--skip-waits", action="store_true")
+    parser.add_argument("--format", choices=("text", "json"), default="text")
+    parser.add_argument("--play")
+    parser.add_argument("--record")
+    parser.add_argument("--no-cache", action="store_true")
+    parser.add_argument("--trace")
     args = parser.parse_args()
+    if args.play and not args.headless:
+        parser.error("--play needs --headless")
+    if args.record and args.headless:
+        parser.error("--record needs the monitor")
+
+    try:
+        program = load_program(args.input, None if args.no_cache else ImageCache())
+    except ValueError as e:
+        parser.error(str(e))
+    try:
+        script = [] if args.play is None else load_script(args.play)
+    except (OSError, ValueError) as e:
+        parser.error(f"{args.play}: {e}")
+
+    vm = VirtualMachine(program)
+    vm.set_hz(args.hz)
+    debugger = Debugger(vm)
+    for pc in args.breakpoint:
+        debugger.add_breakpoint(pc)
+    for begin, end, mode in args.watch:
+        debugger.add_watchpoint(begin, end, read="r" in mode, write="w" in mode)
+    trace = None
+    if args.trace is not None:
+        trace = TraceRecorder(args.trace)
+        trace.attach(vm)
 
-    with open(args.input, "rb") as f:
-        data = f.read()
+    try:
+        if args.headless:
+            player = InputPlayer(script)
+            result = run_headless(vm, debugger, player, args)
+            if args.format == "json":
+                print(json.dumps(result))
+            else:
+                print(format_result(result))
+        else:
+            # Textual is only imported once the monitor is actually wanted.
+            from monitor import VirtualMachineMonitor
 
-    vm = VirtualMachine(list(data))
-    monitor = VirtualMachineMonitor(vm)
-    monitor.run()
+            rewind = None
+            if args.rewind_mb > 0:
+                rewind = RewindBuffer(max_bytes=args.rewind_mb * 1024 * 1024)
+            profiler = Profiler() if args.profile else None
+            scheduler = Scheduler(args.hz, args.speed)
+            recorder = None if args.record is None else InputRecorder()
+            monitor = VirtualMachineMonitor(
+                vm, rewind, profiler, debugger, scheduler, recorder
+            )
+            monitor.run()
+            if recorder is not None:
+                recorder.save(args.record)
+    finally:
+        if trace is not None:
+            trace.close()
@@ -0,0 +1,316 @@
+import numpy as np
+
+from virtual_machine import (
+    VirtualMachine,
+    MemoryLayout,
+    SystemLayout,
+    Register,
+    Opcode,
+    ServiceCall,
+)
+
+
+_LOWEST_KEY = np.zeros(0x10000, dtype=np.uint8)
+for _keys in range(1, 0x10000):
+    _LOWEST_KEY[_keys] = (_keys & -_keys).bit_length() - 1
+del _keys
+
+_SERVICE_CALLS = set(ServiceCall)
+
+_PUSH_OPS = {
+    Opcode.PUSHA: Register.A,
+    Opcode.PUSHB: Register.B,
+    Opcode.PUSHY: Register.Y,
+    Opcode.PUSHZ: Register.Z,
+}
+_POP_OPS = {
+    Opcode.POPA: Register.A,
+    Opcode.POPB: Register.B,
+    Opcode.POPY: Register.Y,
+    Opcode.POPZ: Register.Z,
+}
+
+
+class BatchMachine:
+    def __init__(
+        self, data: list[int] | bytes, lanes: int, hz: int = VirtualMachine.HZ
+    ):
+        assert 0 < hz <= VirtualMachine.MAX_HZ
+        vm = VirtualMachine(list(data))
+        self.hz = hz
+        self.mem = np.tile(np.frombuffer(bytes(vm.mem), dtype=np.uint8), (lanes, 1))
+        self.clock = np.zeros(lanes, dtype=np.int64)
+        self.halted = np.zeros(lanes, dtype=bool)
+        self.faulted = np.zeros(lanes, dtype=bool)
+        self.registers = {register: self.mem[:, register] for register in Register}
+
+    @classmethod
+    def from_machine(cls, vm: VirtualMachine, lanes: int) -> "BatchMachine":
+        batch = cls(bytes(0x80), lanes, vm.HZ)
+        batch.mem[:] = np.frombuffer(bytes(vm.mem), dtype=np.uint8)
+        batch.clock[:] = vm.clock
+        return batch
+
+    @property
+    def lanes(self) -> int:
+        return self.mem.shape[0]
+
+    def export(self, lane: int) -> VirtualMachine:
+        vm = VirtualMachine(bytes(0x80))
+        vm.set_hz(self.hz)
+        nibbles = self.mem[lane]
+        vm.load(bytes((nibbles[0::2] << 4) | nibbles[1::2]))
+        vm.clock = int(self.clock[lane])
+        vm.halted = bool(self.halted[lane])
+        return vm
+
+    def get_reg(self, register: Register) -> np.ndarray:
+        mem = self.mem
+        if register == Register.PC or register == Register.SP:
+            return (mem[:, register].astype(np.int32) << 4) | mem[:, register + 1]
+        if register == Register.F:
+            return (mem[:, register] >> 3) & 0x1
+        return mem[:, register]
+
+    def prese_key(self, key: int, lanes=slice(None)) -> None:
+        assert 0x0 <= key <= 0xF
+        self.mem[lanes, SystemLayout.KEY_STATE_BEGIN + key // 4] |= 1 << (key % 4)
+
+    def release_key(self, key: int, lanes=slice(None)) -> None:
+        assert 0x0 <= key <= 0xF
+        self.mem[lanes, SystemLayout.KEY_STATE_BEGIN + key // 4] &= ~(1 << (key % 4)) & 0xF
+
+    def release_all_key(self, lanes=slice(None)) -> None:
+        self.mem[lanes, SystemLayout.KEY_STATE_BEGIN : SystemLayout.KEY_STATE_END] = 0
+
+    def run(self, cycles: int) -> None:
+        for _ in range(cycles):
+            self.step()
+
+    def step(self) -> None:
+        mem = self.mem
+        lanes = np.flatnonzero(~(self.halted | self.faulted))
+
+        wait = mem[lanes, SystemLayout.WAIT_COUNT : SystemLayout.WAIT_COUNT + 4].astype(
+            np.int32
+        )
+        wait_count = wait[:, 0] | (wait[:, 1] << 4) | (wait[:, 2] << 8) | (wait[:, 3] << 12)
+        waiting = wait_count > 0
+        self._set_wait_count(lanes[waiting], wait_count[waiting] - 1)
+        self.clock[lanes[waiting]] += 1
+        lanes = lanes[~waiting]
+
+        pc = (mem[lanes, Register.PC].astype(np.int32) << 4) | mem[lanes, Register.PC + 1]
+        opcode = mem[lanes, pc]
+        op1 = mem[lanes, (pc + 1) & 0xFF].astype(np.int32)
+        op2 = mem[lanes, (pc + 2) & 0xFF].astype(np.int32)
+        addr = (op1 << 4) | op2
+        is_call = (opcode == Opcode.JMPF) & (addr == (Opcode.CALL & 0xFF))
+        length = np.where(opcode < Opcode.LDI, 1, np.where(opcode < Opcode.JMPF, 2, 3))
+        length = np.where(is_call, 5, length)
+
+        sp = (mem[lanes, Register.SP].astype(np.int32) << 4) | mem[lanes, Register.SP + 1]
+        faults = self._faults(opcode, addr, sp)
+        self.faulted[lanes[faults]] = True
+        keep = ~faults
+        lanes, pc, opcode, op1, op2, addr, length = (
+            lanes[keep],
+            pc[keep],
+            opcode[keep],
+            op1[keep],
+            op2[keep],
+            addr[keep],
+            length[keep],
+        )
+
+        self.clock[lanes] += 1
+        next_pc = (pc + length) & 0xFF
+        self._set_pc(lanes, next_pc)
+
+        for op in range(Opcode.JMPF):
+            m = opcode == op
+            if m.any():
+                self._exec_op(op, lanes[m], op1[m])
+
+        m = opcode == Opcode.JMPF
+        if m.any():
+            self._exec_jmpf(lanes[m], pc[m], next_pc[m], addr[m], mem)
+
+    def _faults(self, opcode: np.ndarray, addr: np.ndarray, sp: np.ndarray) -> np.ndarray:
+        # Lanes where VirtualMachine would fail an address assertion.
+        jmpf = opcode == Opcode.JMPF
+        push = np.isin(addr, [int(op) & 0xFF for op in _PUSH_OPS])
+        pop = np.isin(addr, [int(op) & 0xFF for op in _POP_OPS])
+        return jmpf & (
+            ((addr == (Opcode.CALL & 0xFF)) & (((sp - 2) & 0xFF) >= 0xFE))
+            | ((addr == (Opcode.RET & 0xFF)) & (sp >= 0xFE))
+            | (push & (sp == 0x00))
+            | (pop & (sp == 0xFF))
+        )
+
+    def _set_pc(self, lanes: np.ndarray, pc: np.ndarray) -> None:
+        self.mem[lanes, Register.PC] = pc >> 4
+        self.mem[lanes, Register.PC + 1] = pc & 0xF
+
+    def _set_sp(self, lanes: np.ndarray, sp: np.ndarray) -> None:
+        self.mem[lanes, Register.SP] = sp >> 4
+        self.mem[lanes, Register.SP + 1] = sp & 0xF
+
+    def _set_f(self, lanes: np.ndarray, f) -> None:
+        self.mem[lanes, Register.F] = np.asarray(f, dtype=np.uint8) << 3
+
+    def _set_wait_count(self, lanes: np.ndarray, wait_count: np.ndarray) -> None:
+        for i in range(4):
+            self.mem[lanes, SystemLayout.WAIT_COUNT + i] = (wait_count >> (i * 4)) & 0xF
+
+    def _set_binary_led(self, lanes: np.ndarray, value: np.ndarray) -> None:
+        self.mem[lanes, SystemLayout.BINARY_LED] = value & 0xF
+        self.mem[lanes, SystemLayout.BINARY_LED + 1] = value >> 4
+
+    def _binary_led(self, lanes: np.ndarray) -> np.ndarray:
+        mem = self.mem
+        return mem[lanes, SystemLayout.BINARY_LED].astype(np.int32) | (
+            mem[lanes, SystemLayout.BINARY_LED + 1].astype(np.int32) << 4
+        )
+
+    def _exec_op(self, op: int, lanes: np.ndarray, operand: np.ndarray) -> None:
+        mem = self.mem
+        a = mem[lanes, Register.A].astype(np.int32)
+        y = mem[lanes, Register.Y].astype(np.int32)
+        match op:
+            case Opcode.INK:
+                keys = mem[lanes, SystemLayout.KEY_STATE_BEGIN : SystemLayout.KEY_STATE_END]
+                keys = keys.astype(np.int32)
+                keys = keys[:, 0] | (keys[:, 1] << 4) | (keys[:, 2] << 8) | (keys[:, 3] << 12)
+                pressed = keys != 0
+                mem[lanes[pressed], Register.A] = _LOWEST_KEY[keys[pressed]]
+                self._set_f(lanes, ~pressed)
+            case Opcode.OUTN:
+                mem[lanes, SystemLayout.NUMERIC_LED] = a
+                self._set_f(lanes, 1)
+            case Opcode.ABYZ | Opcode.AY:
+                # _swap_reg leaves both registers unchanged.
+                self._set_f(lanes, 1)
+            case Opcode.ST:
+                mem[lanes, y + 50] = a
+                self._set_f(lanes, 1)
+            case Opcode.LD:
+                mem[lanes, Register.A] = mem[lanes, y + 50]
+                self._set_f(lanes, 1)
+            case Opcode.ADD:
+                val = mem[lanes, y + 50] + a
+                mem[lanes, Register.A] = val & 0xF
+                self._set_f(lanes, val >> 4)
+            case Opcode.SUB:
+                val = mem[lanes, y + 50] - a
+                self._set_f(lanes, val < 0)
+                mem[lanes, Register.A] = val & 0xF
+            case Opcode.LDI:
+                mem[lanes, Register.A] = operand
+                self._set_f(lanes, 1)
+            case Opcode.ADDI:
+                val = a + operand
+                mem[lanes, Register.A] = val & 0xF
+                self._set_f(lanes, val >> 4)
+            case Opcode.LDYI:
+                mem[lanes, Register.Y] = operand
+                self._set_f(lanes, 1)
+            case Opcode.ADDYI:
+                val = y + operand
+                mem[lanes, Register.Y] = val & 0xF
+                self._set_f(lanes, val >> 4)
+            case Opcode.CPI:
+                self._set_f(lanes, a != operand)
+            case Opcode.CPYI:
+                self._set_f(lanes, y != operand)
+            case Opcode.SCALL:
+                for srv in range(0x10):
+                    m = operand == srv
+                    if m.any():
+                        self._scall(srv, lanes[m], a[m], y[m])
+
+    def _scall(self, srv: int, lanes: np.ndarray, a: np.ndarray, y: np.ndarray) -> None:
+        mem = self.mem
+        match srv:
+            case ServiceCall.TURN_ON_REGISTER:
+                self._set_binary_led(lanes, (self._binary_led(lanes) | (1 << y)) & 0x7F)
+            case ServiceCall.TURN_OFF_REGISTER:
+                self._set_binary_led(lanes, (self._binary_led(lanes) & ~(1 << y)) & 0x7F)
+            case ServiceCall.INVERT_ALL_BITS:
+                mem[lanes, Register.A] = (~a) & 0xF
+            case ServiceCall.RIGHT_SHIFT:
+                mem[lanes, Register.A] = a >> 1
+                self._set_f(lanes, a & 1)
+                return
+            case ServiceCall.WAIT:
+                self._set_wait_count(lanes, (a + 1) * self.hz // 10)
+            case ServiceCall.TURN_ON_MEMORY:
+                val = mem[lanes, 0x5E].astype(np.int32) | ((mem[lanes, 0x5F] & 0x7) << 4)
+                bit = np.where(val < 7, 1 << np.minimum(val, 7), 0)
+                self._set_binary_led(lanes, (self._binary_led(lanes) | bit) & 0x7F)
+            case _ if srv not in _SERVICE_CALLS:
+                return
+        self._set_f(lanes, 1)
+
+    def _exec_jmpf(
+        self,
+        lanes: np.ndarray,
+        pc: np.ndarray,
+        next_pc: np.ndarray,
+        addr: np.ndarray,
+        mem: np.ndarray,
+    ) -> None:
+        ex = (addr >= MemoryLayout.SYSTEM_BEGIN) & (addr < MemoryLayout.STACK_BEGIN)
+
+        m = ~ex
+        if m.any():
+            jl, jpc, jaddr = lanes[m], pc[m], addr[m]
+            taken = mem[jl, Register.F] & 0x8 != 0
+            self._set_f(jl[~taken], 1)
+            self._set_pc(jl[taken], jaddr[taken])
+            self.halted[jl[taken & (jaddr == jpc)]] = True
+
+        m = ex & (addr == (Opcode.CALL & 0xFF))
+        if m.any():
+            cl, cpc = lanes[m], pc[m]
+            target = (mem[cl, (cpc + 3) & 0xFF].astype(np.int32) << 4) | mem[
+                cl, (cpc + 4) & 0xFF
+            ]
+            ret_addr = (next_pc[m] - 1) & 0xFF
+            sp = (self.get_reg(Register.SP)[cl] - 2) & 0xFF
+            self._set_sp(cl, sp)
+            mem[cl, sp + 1] = ret_addr >> 4
+            mem[cl, sp + 2] = ret_addr & 0xF
+            self._set_pc(cl, target)
+            self._set_f(cl, 1)
+
+        m = ex & (addr == (Opcode.RET & 0xFF))
+        if m.any():
+            rl = lanes[m]
+            sp = self.get_reg(Register.SP)[rl]
+            ret_addr = (mem[rl, sp + 1].astype(np.int32) << 4) | mem[rl, sp + 2]
+            self._set_sp(rl, (sp + 2) & 0xFF)
+            self._set_pc(rl, (ret_addr + 1) & 0xFF)
+            self._set_f(rl, 1)
+
+        for op, register in _PUSH_OPS.items():
+            m = ex & (addr == (op & 0xFF))
+            if m.any():
+                pl = lanes[m]
+                sp = (self.get_reg(Register.SP)[pl] - 1) & 0xFF
+                self._set_sp(pl, sp)
+                mem[pl, sp + 1] = mem[pl, register]
+                self._set_f(pl, 1)
+
+        for op, register in _POP_OPS.items():
+            m = ex & (addr == (op & 0xFF))
+            if m.any():
+                pl = lanes[m]
+                sp = self.get_reg(Register.SP)[pl]
+                mem[pl, register] = mem[pl, sp + 1]
+                self._set_sp(pl, (sp + 1) & 0xFF)
+                self._set_f(pl, 1)
+
+        m = ex & np.isin(addr, [Opcode.IOCTRL & 0xFF, Opcode.OUT & 0xFF, Opcode.IN & 0xFF])
+        if m.any():
+            self._set_f(lanes[m], 1)
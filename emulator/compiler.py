@@ -0,0 +1,251 @@
+from events import EventKind
+from virtual_machine import (
+    VirtualMachine,
+    MemoryLayout,
+    SystemLayout,
+    Register,
+    Opcode,
+    ServiceCall,
+)
+
+
+MAX_BLOCK_LENGTH = 64
+
+_REGISTERS = (
+    ("a", Register.A),
+    ("b", Register.B),
+    ("y", Register.Y),
+    ("z", Register.Z),
+)
+
+
+def _ink(mem: bytearray) -> int:
+    for i in range(4):
+        keys = mem[SystemLayout.KEY_STATE_BEGIN + i]
+        if keys:
+            return i * 4 + ((keys & -keys).bit_length() - 1)
+    return -1
+
+
+class Block:
+    def __init__(self, pc: int, code: bytes, length: int, func):
+        self.pc = pc
+        self.end = pc + len(code)
+        self.code = code
+        self.length = length
+        self.func = func
+
+
+class BlockCompiler:
+    def __init__(self, vm: VirtualMachine):
+        self.vm = vm
+        self._blocks: dict[int, Block] = {}
+
+    def run(self, max_cycles: int, skip_waits: bool = False) -> int:
+        vm = self.vm
+        if vm.observed:
+            return vm.run(max_cycles, skip_waits).cycles
+        mem = vm.mem
+        blocks = self._blocks
+        start = vm.clock
+        end = start + max_cycles
+        vm.halted = False
+        if skip_waits:
+            vm._wait_limit = end
+        try:
+            while vm.clock < end:
+                if vm.waiting:
+                    vm.cycle()
+                    if vm.halted:
+                        break
+                    continue
+                pc = (mem[Register.PC] << 4) | mem[Register.PC + 1]
+                block = blocks.get(pc)
+                if block is None or mem[pc : block.end] != block.code:
+                    block = self._compile(pc)
+                if block is None or block.length > end - vm.clock:
+                    vm.cycle()
+                    if vm.halted:
+                        break
+                    continue
+                block.func(vm, mem)
+                vm.clock += block.length
+                if vm.halted:
+                    break
+        finally:
+            vm._wait_limit = 0
+        return vm.clock - start
+
+    def invalidate(self) -> None:
+        self._blocks.clear()
+
+    def _compile(self, pc: int) -> Block | None:
+        self._blocks.pop(pc, None)
+        vm = self.vm
+        mem = vm.mem
+        lines = []
+        insts = []
+        addr = pc
+        terminated = False
+        while len(insts) < MAX_BLOCK_LENGTH:
+            inst = vm._decode(addr)
+            size = inst[2]
+            if addr + size - 1 > MemoryLayout.PROGRAM_END:
+                break
+            lines.append(f"    # 0x{addr:02X}")
+            insts.append(inst)
+            terminated = self._emit(
+                lines, mem[addr], inst[1], mem, addr, addr + size, len(insts)
+            )
+            addr += size
+            if terminated:
+                break
+        if not insts:
+            return None
+        if not terminated:
+            lines.append(f"    _exit(vm, mem, a, b, y, z, f, 0x{addr & 0xFF:02X})")
+        lines.append(f"    vm._last = _insts[{len(insts) - 1}]")
+        source = "def _block(vm, mem):\n" + self._prologue() + "\n".join(lines) + "\n"
+        namespace = {"_ink": _ink, "_exit": _exit, "_insts": insts}
+        exec(compile(source, f"<block 0x{pc:02X}>", "exec"), namespace)
+        block = Block(pc, bytes(mem[pc:addr]), len(insts), namespace["_block"])
+        self._blocks[pc] = block
+        return block
+
+    def _prologue(self) -> str:
+        lines = [f"    {name} = mem[{int(reg)}]" for name, reg in _REGISTERS]
+        lines.append(f"    f = (mem[{int(Register.F)}] >> 3) & 0x1")
+        return "\n".join(lines) + "\n"
+
+    def _emit(
+        self,
+        lines: list[str],
+        opcode: int,
+        operand: int,
+        mem: bytearray,
+        addr: int,
+        next_pc: int,
+        clock: int,
+    ) -> bool:
+        # clock is the instruction's offset from vm.clock, which is only
+        # advanced once the whole block has run. It is also one past the
+        # instruction's index in _insts.
+        emit = lines.append
+        data = "y + 50"
+        match opcode:
+            case Opcode.INK:
+                emit("    key = _ink(mem)")
+                emit("    if key < 0:")
+                emit("        f = 1")
+                emit("    else:")
+                emit("        a = key")
+                emit("        f = 0")
+            case Opcode.OUTN:
+                led = int(SystemLayout.NUMERIC_LED)
+                kind = int(EventKind.NUMERIC_LED)
+                emit(f"    if mem[{led}] != a:")
+                emit(f"        vm.events.emit({kind}, vm.clock + {clock}, a)")
+                emit(f"    mem[{led}] = a")
+                emit("    f = 1")
+            case Opcode.ABYZ | Opcode.AY:
+                # _swap_reg leaves both registers unchanged.
+                emit("    f = 1")
+            case Opcode.ST:
+                emit(f"    vm.set_mem({data}, a)")
+                emit("    f = 1")
+                emit(f"    _exit(vm, mem, a, b, y, z, f, 0x{next_pc & 0xFF:02X})")
+                return True
+            case Opcode.LD:
+                emit(f"    a = mem[{data}]")
+                emit("    f = 1")
+            case Opcode.ADD:
+                emit(f"    val = mem[{data}] + a")
+                emit("    a = val & 0xF")
+                emit("    f = val >> 4")
+            case Opcode.SUB:
+                emit(f"    val = mem[{data}] - a")
+                emit("    if val < 0:")
+                emit("        val += 0x10")
+                emit("        f = 1")
+                emit("    else:")
+                emit("        f = 0")
+                emit("    a = val & 0xF")
+            case Opcode.LDI:
+                emit(f"    a = {operand}")
+                emit("    f = 1")
+            case Opcode.ADDI:
+                emit(f"    val = a + {operand}")
+                emit("    a = val & 0xF")
+                emit("    f = val >> 4")
+            case Opcode.LDYI:
+                emit(f"    y = {operand}")
+                emit("    f = 1")
+            case Opcode.ADDYI:
+                emit(f"    val = y + {operand}")
+                emit("    y = val & 0xF")
+                emit("    f = val >> 4")
+            case Opcode.CPI:
+                emit(f"    f = 0 if a == {operand} else 1")
+            case Opcode.CPYI:
+                emit(f"    f = 0 if y == {operand} else 1")
+            case Opcode.SCALL:
+                return self._emit_scall(lines, operand, next_pc, clock)
+            case Opcode.JMPF:
+                target = (mem[addr + 1] << 4) | mem[addr + 2]
+                if self.vm._ex_ops[target] is None:
+                    emit("    if f == 0:")
+                    emit(f"        _exit(vm, mem, a, b, y, z, 1, 0x{next_pc & 0xFF:02X})")
+                    emit("    else:")
+                    emit(f"        _exit(vm, mem, a, b, y, z, f, 0x{target:02X})")
+                    if target == addr:
+                        emit("        vm.halted = True")
+                    return True
+                emit(f"    _exit(vm, mem, a, b, y, z, f, 0x{next_pc & 0xFF:02X})")
+                # Extension ops can fault, e.g. RET on an empty stack, so the
+                # instruction is recorded before the call, as cycle() does.
+                emit(f"    vm._last = _insts[{clock - 1}]")
+                emit(f"    vm.clock += {clock}")
+                emit(f"    vm._ex_ops[0x{target:02X}](vm, {operand})")
+                emit(f"    vm.clock -= {clock}")
+                return True
+        return False
+
+    def _emit_scall(
+        self, lines: list[str], srv: int, next_pc: int, clock: int
+    ) -> bool:
+        emit = lines.append
+        match srv:
+            case ServiceCall.INVERT_ALL_BITS:
+                emit("    a = (~a) & 0xF")
+                emit("    f = 1")
+            case ServiceCall.SWAP_AUX_REGISTERS:
+                # _swap_reg leaves both registers unchanged.
+                emit("    f = 1")
+            case ServiceCall.RIGHT_SHIFT:
+                emit("    f = a & 1")
+                emit("    a = a >> 1")
+            case ServiceCall.WAIT:
+                # HZ is read when the block runs, since set_hz() may change it.
+                emit("    vm.set_wait_count((a + 1) * vm.HZ // 10)")
+                emit(f"    _exit(vm, mem, a, b, y, z, 1, 0x{next_pc & 0xFF:02X})")
+                return True
+            case _ if self.vm._srvs[srv] is VirtualMachine._srv_undefined:
+                pass
+            case _:
+                emit(f"    _exit(vm, mem, a, b, y, z, f, 0x{next_pc & 0xFF:02X})")
+                emit(f"    vm._last = _insts[{clock - 1}]")
+                emit(f"    vm.clock += {clock}")
+                emit(f"    vm._op_scall({srv})")
+                emit(f"    vm.clock -= {clock}")
+                lines.append(self._prologue().rstrip("\n"))
+        return False
+
+
+def _exit(vm, mem, a, b, y, z, f, pc) -> None:
+    mem[Register.A] = a
+    mem[Register.B] = b
+    mem[Register.Y] = y
+    mem[Register.Z] = z
+    mem[Register.F] = f << 3
+    mem[Register.PC] = pc >> 4
+    mem[Register.PC + 1] = pc & 0xF
@@ -0,0 +1,193 @@
+from dataclasses import dataclass
+from enum import IntEnum
+from typing import Callable
+
+from virtual_machine import VirtualMachine, SystemLayout, Register, BreakpointHit
+
+
+class HitKind(IntEnum):
+    BREAKPOINT = 0
+    READ = 1
+    WRITE = 2
+
+
+@dataclass(frozen=True)
+class Hit:
+    kind: HitKind
+    pc: int
+    clock: int
+    addr: int | None = None
+
+
+@dataclass(frozen=True)
+class Watchpoint:
+    begin: int
+    end: int
+    read: bool = False
+    write: bool = True
+
+
+class Debugger:
+    # Nothing is hooked into the VM while no breakpoint or watchpoint is set.
+    # Adding the first one registers the debugger as an observer, and
+    # watchpoints additionally shadow get_mem/set_mem on the instance;
+    # removing the last one takes all of that out again.
+    #
+    # Hits are raised as BreakpointHit from before_cycle, so a PC breakpoint
+    # stops before its instruction runs and a watchpoint stops right after
+    # the accessing instruction. The first cycle after a stop is not checked
+    # again, which lets run/step resume from a breakpoint.
+    #
+    # Instruction handlers read the keypad, registers, LEDs and wait counter
+    # straight from memory rather than through get_mem, so reads of that
+    # system area cannot be watched and such watchpoints are refused.
+
+    SYSTEM_BEGIN = SystemLayout.KEY_STATE_BEGIN
+    SYSTEM_END = SystemLayout.WAIT_COUNT + 3
+
+    def __init__(self, vm: VirtualMachine):
+        self.vm = vm
+        self.hit: Hit | None = None
+        self._breakpoints: dict[int, Callable[[VirtualMachine], bool] | None] = {}
+        self._watchpoints: list[Watchpoint] = []
+        self._reads = bytearray(0x100)
+        self._writes = bytearray(0x100)
+        self._attached = False
+        self._pending: Hit | None = None
+        self._resume_clock = -1
+        self._in_cycle = False
+        self._before = b""
+        self._pc = 0
+
+    @property
+    def breakpoints(self) -> dict[int, Callable[[VirtualMachine], bool] | None]:
+        return dict(self._breakpoints)
+
+    @property
+    def watchpoints(self) -> list[Watchpoint]:
+        return list(self._watchpoints)
+
+    def add_breakpoint(
+        self, pc: int, condition: Callable[[VirtualMachine], bool] | None = None
+    ) -> None:
+        assert 0x00 <= pc <= 0xFF
+        self._breakpoints[pc] = condition
+        self._update()
+
+    def remove_breakpoint(self, pc: int) -> None:
+        self._breakpoints.pop(pc, None)
+        self._update()
+
+    def toggle_breakpoint(self, pc: int) -> bool:
+        if pc in self._breakpoints:
+            self.remove_breakpoint(pc)
+            return False
+        self.add_breakpoint(pc)
+        return True
+
+    def add_watchpoint(
+        self, begin: int, end: int | None = None, read: bool = False, write: bool = True
+    ) -> Watchpoint:
+        end = begin if end is None else end
+        assert 0x00 <= begin <= end <= 0xFF
+        assert read or write
+        assert not read or self.can_watch_reads(begin, end)
+        watchpoint = Watchpoint(begin, end, read, write)
+        self._watchpoints.append(watchpoint)
+        self._update()
+        return watchpoint
+
+    @classmethod
+    def can_watch_reads(cls, begin: int, end: int) -> bool:
+        return end < cls.SYSTEM_BEGIN or begin > cls.SYSTEM_END
+
+    def remove_watchpoint(self, watchpoint: Watchpoint) -> None:
+        self._watchpoints.remove(watchpoint)
+        self._update()
+
+    def clear(self) -> None:
+        self._breakpoints.clear()
+        self._watchpoints.clear()
+        self._update()
+
+    def resume(self) -> None:
+        self._pending = None
+        self._resume_clock = self.vm.clock
+
+    def before_cycle(self, vm: VirtualMachine) -> None:
+        if self._pending is not None:
+            self._stop(self._pending)
+        mem = vm.mem
+        pc = (mem[Register.PC] << 4) | mem[Register.PC + 1]
+        self._pc = pc
+        if vm.clock == self._resume_clock:
+            self._resume_clock = -1
+        elif pc in self._breakpoints and not vm.waiting:
+            condition = self._breakpoints[pc]
+            if condition is None or condition(vm):
+                self._resume_clock = vm.clock
+                self._stop(Hit(HitKind.BREAKPOINT, pc, vm.clock))
+        if self._watchpoints:
+            self._before = bytes(mem)
+            self._in_cycle = True
+
+    def after_cycle(self, vm: VirtualMachine) -> None:
+        if not self._in_cycle:
+            return
+        self._in_cycle = False
+        if self._pending is not None:
+            return
+        mem = vm.mem
+        for watchpoint in self._watchpoints:
+            begin, end = watchpoint.begin, watchpoint.end + 1
+            if watchpoint.write and self._before[begin:end] != mem[begin:end]:
+                for addr in range(begin, end):
+                    if self._before[addr] != mem[addr]:
+                        self._pending = Hit(HitKind.WRITE, self._pc, vm.clock, addr)
+                        return
+
+    def _stop(self, hit: Hit) -> None:
+        self._pending = None
+        self.hit = hit
+        raise BreakpointHit(hit)
+
+    def _get_mem(self, addr: int) -> int:
+        value = VirtualMachine.get_mem(self.vm, addr)
+        if self._in_cycle and self._reads[addr] and self._pending is None:
+            self._pending = Hit(HitKind.READ, self._pc, self.vm.clock, addr)
+        return value
+
+    def _set_mem(self, addr: int, value: int) -> None:
+        VirtualMachine.set_mem(self.vm, addr, value)
+        if self._in_cycle and self._writes[addr] and self._pending is None:
+            self._pending = Hit(HitKind.WRITE, self._pc, self.vm.clock, addr)
+
+    def _update(self) -> None:
+        vm = self.vm
+        self._reads[:] = bytes(0x100)
+        self._writes[:] = bytes(0x100)
+        for watchpoint in self._watchpoints:
+            size = watchpoint.end - watchpoint.begin + 1
+            if watchpoint.read:
+                self._reads[watchpoint.begin : watchpoint.end + 1] = b"\x01" * size
+            if watchpoint.write:
+                self._writes[watchpoint.begin : watchpoint.end + 1] = b"\x01" * size
+
+        if self._watchpoints:
+            vm.get_mem = self._get_mem
+            vm.set_mem = self._set_mem
+        elif "get_mem" in vm.__dict__:
+            del vm.get_mem
+            del vm.set_mem
+
+        active = bool(self._breakpoints or self._watchpoints)
+        if active and not self._attached:
+            vm.add_observer(self)
+        elif not active and self._attached:
+            vm.remove_observer(self)
+        self._attached = active
+        self._pending = None
+        self._in_cycle = False
+        # An idle INK loop may be skipped or parked without running a cycle,
+        # so it has to be observed again to hit anything new.
+        vm.reset_idle()
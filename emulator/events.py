@@ -0,0 +1,116 @@
+from array import array
+from dataclasses import dataclass
+from enum import IntEnum
+from typing import Callable
+
+
+class EventKind(IntEnum):
+    NUMERIC_LED = 0
+    BINARY_LED = 1
+    BEEP = 2
+    IO = 3
+    UNIMPLEMENTED = 4
+
+
+class Beep(IntEnum):
+    END = 0
+    ERROR = 1
+    SHORT = 2
+    LONG = 3
+    SCALE = 4
+
+
+class Io(IntEnum):
+    IOCTRL = 0
+    OUT = 1
+    IN = 2
+
+
+@dataclass(frozen=True)
+class Event:
+    # value is the new LED value, the Beep, the Io access or the number of
+    # the unimplemented service call; detail is the scale of a Beep.SCALE
+    # and register A for I/O.
+    kind: EventKind
+    clock: int
+    value: int
+    detail: int = 0
+
+
+class EventBus:
+    # Events are written into preallocated parallel arrays, so emitting one
+    # from an instruction handler is a handful of stores. Nothing is called
+    # back at that point: drain() turns everything since the last drain into
+    # Event objects and hands the batch to each subscriber. One thread may
+    # emit while another drains; if the writer laps the reader, the oldest
+    # events are dropped and counted.
+
+    CAPACITY = 4096
+
+    def __init__(self, capacity: int = CAPACITY):
+        assert capacity > 0 and capacity & (capacity - 1) == 0
+        self.capacity = capacity
+        self.head = 0
+        self.dropped = 0
+        self._mask = capacity - 1
+        self._tail = 0
+        self._kinds = bytearray(capacity)
+        self._clocks = array("Q", bytes(8 * capacity))
+        self._values = array("H", bytes(2 * capacity))
+        self._details = array("H", bytes(2 * capacity))
+        self._subscribers: list[Callable[[list[Event]], None]] = []
+
+    def emit(self, kind: EventKind, clock: int, value: int, detail: int = 0) -> None:
+        i = self.head & self._mask
+        self._kinds[i] = kind
+        self._clocks[i] = clock
+        self._values[i] = value
+        self._details[i] = detail
+        self.head += 1
+
+    def subscribe(self, subscriber: Callable[[list[Event]], None]) -> None:
+        self._subscribers.append(subscriber)
+
+    def unsubscribe(self, subscriber: Callable[[list[Event]], None]) -> None:
+        self._subscribers.remove(subscriber)
+
+    def drain(self) -> list[Event]:
+        head = self.head
+        start = max(self._tail, head - self.capacity)
+        self.dropped += start - self._tail
+        mask = self._mask
+        events = [
+            Event(
+                EventKind(self._kinds[i & mask]),
+                self._clocks[i & mask],
+                self._values[i & mask],
+                self._details[i & mask],
+            )
+            for i in range(start, head)
+        ]
+        lapped = self.head - self.capacity - start
+        if lapped > 0:
+            events = events[lapped:]
+            self.dropped += lapped
+        self._tail = head
+        if events:
+            for subscriber in self._subscribers:
+                subscriber(events)
+        return events
+
+
+def format_event(event: Event) -> str:
+    match event.kind:
+        case EventKind.NUMERIC_LED:
+            return f"NUMERIC LED: {event.value:X}"
+        case EventKind.BINARY_LED:
+            return f"BINARY LED: {event.value:07b}"
+        case EventKind.BEEP if event.value == Beep.SCALE:
+            return f"BEEP: {event.detail:X}"
+        case EventKind.BEEP:
+            return f"BEEP: {Beep(event.value).name}"
+        case EventKind.IO:
+            return f"IO: {Io(event.value).name} A={event.detail:X}"
+        case EventKind.UNIMPLEMENTED:
+            return f"UNIMPLEMENTED: srv {event.value:X}"
+    return event.kind.name
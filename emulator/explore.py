@@ -0,0 +1,230 @@
+import argparse
+import functools
+import hashlib
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass, field
+from typing import Callable
+
+from virtual_machine import (
+    VirtualMachine,
+    VMState,
+    MemoryLayout,
+    Register,
+    Opcode,
+)
+from loader import load_program
+
+
+MAX_SEGMENT = 10000
+CHUNK_SIZE = 256
+
+# One input choice per INK: None for no key, otherwise the key held down.
+Path = tuple[int | None, ...]
+
+
+@dataclass(frozen=True)
+class Query:
+    name: str
+    predicate: Callable[[VirtualMachine], bool]
+
+
+@dataclass
+class Exploration:
+    states: int = 0
+    depth: int = 0
+    complete: bool = False
+    halted: int = 0
+    faulted: int = 0
+    diverged: int = 0
+    witnesses: dict[str, Path] = field(default_factory=dict)
+
+
+def _numeric_led_is(value: int, vm: VirtualMachine) -> bool:
+    return vm.get_numeric_led() == value
+
+
+def _binary_led_is(value: int, vm: VirtualMachine) -> bool:
+    return vm.get_binary_led() == value
+
+
+def _pc_is(addr: int, vm: VirtualMachine) -> bool:
+    return vm.get_reg(Register.PC) == addr
+
+
+def _sp_underflow(vm: VirtualMachine) -> bool:
+    return vm.get_reg(Register.SP) < MemoryLayout.STACK_BEGIN
+
+
+def numeric_led_is(value: int) -> Query:
+    return Query(f"numeric_led={value:X}", functools.partial(_numeric_led_is, value))
+
+
+def binary_led_is(value: int) -> Query:
+    return Query(f"binary_led={value:02X}", functools.partial(_binary_led_is, value))
+
+
+def pc_is(addr: int) -> Query:
+    return Query(f"pc={addr:02X}", functools.partial(_pc_is, addr))
+
+
+def sp_underflow() -> Query:
+    return Query("sp_underflow", _sp_underflow)
+
+
+def _digest(state: bytes) -> bytes:
+    return hashlib.blake2b(state, digest_size=16).digest()
+
+
+def _check(vm: VirtualMachine, queries: list[Query], path: Path, hits: dict) -> None:
+    for query in queries:
+        if query.name not in hits and query.predicate(vm):
+            hits[query.name] = path
+
+
+def _advance(vm: VirtualMachine, queries: list[Query], path: Path, hits: dict) -> str:
+    # Runs until the next INK is about to execute, with waits skipped.
+    mem = vm.mem
+    for _ in range(MAX_SEGMENT):
+        if vm.waiting:
+            vm.skip_wait()
+        pc = (mem[Register.PC] << 4) | mem[Register.PC + 1]
+        if mem[pc] == Opcode.INK:
+            return "ink"
+        vm.cycle()
+        _check(vm, queries, path, hits)
+        if vm.halted:
+            return "halted"
+    return "diverged"
+
+
+def _expand(frontier: list[tuple[bytes, Path]], queries: list[Query]) -> tuple:
+    vm = VirtualMachine(bytes(0x80))
+    successors = []
+    hits = {}
+    counts = {"halted": 0, "faulted": 0, "diverged": 0}
+    for state, path in frontier:
+        for key in (None, *range(0x10)):
+            vm.restore(VMState(state))
+            branch = path + (key,)
+            try:
+                if key is not None:
+                    vm.prese_key(key)
+                vm.cycle()
+                vm.release_all_key()
+                _check(vm, queries, branch, hits)
+                outcome = "halted" if vm.halted else "ink"
+                if outcome == "ink":
+                    outcome = _advance(vm, queries, branch, hits)
+            except AssertionError:
+                outcome = "faulted"
+            if outcome == "ink":
+                successors.append((bytes(vm.mem), branch))
+            else:
+                counts[outcome] += 1
+    return successors, hits, counts
+
+
+class Explorer:
+    # Breadth-first search over the machine states at which an INK is about
+    # to run. Each state branches on no key and on each of the 16 keys held
+    # for that INK; keys are released again straight after it, as the
+    # monitor does. The visited set keeps a 16-byte digest per state, and
+    # only the current frontier holds full states.
+
+    def __init__(self, data: bytes | list[int], queries: list[Query], jobs: int = 1):
+        self.data = bytes(data)
+        self.queries = queries
+        self.jobs = jobs
+
+    def explore(
+        self, max_states: int | None = None, max_depth: int | None = None
+    ) -> Exploration:
+        result = Exploration()
+        vm = VirtualMachine(self.data)
+        outcome = _advance(vm, self.queries, (), result.witnesses)
+        if outcome != "ink":
+            setattr(result, outcome, 1)
+            result.complete = True
+            return result
+
+        visited = {_digest(bytes(vm.mem))}
+        frontier = [(bytes(vm.mem), ())]
+        executor = ProcessPoolExecutor(self.jobs) if self.jobs > 1 else None
+        try:
+            while frontier:
+                if max_depth is not None and result.depth >= max_depth:
+                    break
+                if len(result.witnesses) == len(self.queries) and self.queries:
+                    break
+                result.depth += 1
+                chunks = [
+                    frontier[i : i + CHUNK_SIZE]
+                    for i in range(0, len(frontier), CHUNK_SIZE)
+                ]
+                if executor is None:
+                    expanded = map(_expand, chunks, [self.queries] * len(chunks))
+                else:
+                    expanded = executor.map(
+                        _expand, chunks, [self.queries] * len(chunks)
+                    )
+                frontier = []
+                for successors, hits, counts in expanded:
+                    for name, path in hits.items():
+                        result.witnesses.setdefault(name, path)
+                    result.halted += counts["halted"]
+                    result.faulted += counts["faulted"]
+                    result.diverged += counts["diverged"]
+                    for state, path in successors:
+                        digest = _digest(state)
+                        if digest not in visited:
+                            visited.add(digest)
+                            frontier.append((state, path))
+                result.states = len(visited)
+                if max_states is not None and result.states >= max_states:
+                    break
+            result.complete = not frontier
+        finally:
+            if executor is not None:
+                executor.shutdown()
+        result.states = len(visited)
+        return result
+
+
+def format_path(path: Path) -> str:
+    return " ".join("-" if key is None else f"{key:X}" for key in path)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-i", "--input", required=True)
+    parser.add_argument("--numeric-led", type=lambda s: int(s, 16), action="append")
+    parser.add_argument("--binary-led", type=lambda s: int(s, 16), action="append")
+    parser.add_argument("--pc", type=lambda s: int(s, 16), action="append")
+    parser.add_argument("--sp-underflow", action="store_true")
+    parser.add_argument("--max-states", type=int)
+    parser.add_argument("--max-depth", type=int)
+    parser.add_argument("-j", "--jobs", type=int, default=1)
+    args = parser.parse_args()
+
+    queries = [numeric_led_is(value) for value in args.numeric_led or []]
+    queries += [binary_led_is(value) for value in args.binary_led or []]
+    queries += [pc_is(addr) for addr in args.pc or []]
+    if args.sp_underflow:
+        queries.append(sp_underflow())
+
+    data = load_program(args.input)
+
+    result = Explorer(data, queries, args.jobs).explore(args.max_states, args.max_depth)
+    print(
+        f"states: {result.states} depth: {result.depth}"
+        f" complete: {result.complete} halted: {result.halted}"
+        f" faulted: {result.faulted} diverged: {result.diverged}"
+    )
+    for query in queries:
+        path = result.witnesses.get(query.name)
+        if path is None and result.complete and not result.diverged:
+            print(f"{query.name}: unreachable")
+        elif path is None:
+            print(f"{query.name}: not found")
+        else:
+            print(f"{query.name}: reachable with keys [{format_path(path)}]")
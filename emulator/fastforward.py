@@ -0,0 +1,79 @@
+from virtual_machine import VirtualMachine, Register, RunResult, StopReason
+
+
+class FastForward:
+    # Samples the machine state every time a JMPF is taken and looks for an
+    # exact repeat with Brent's algorithm, which keeps only one saved state.
+    # With no input during a headless run the machine is deterministic, so
+    # a repeated state means it will go round the same loop forever: the
+    # rest of the budget can be skipped in whole periods, or the run can
+    # stop and report the loop. A loop that emitted events on the way is
+    # doing visible work, so it runs normally and sampling stops.
+
+    def __init__(self, vm: VirtualMachine, stop_on_cycle: bool = False):
+        self.vm = vm
+        self.stop_on_cycle = stop_on_cycle
+        self.period = 0
+        self.pc = 0
+
+    def report(self) -> str | None:
+        if self.period == 0:
+            return None
+        return (
+            f"program is stuck in a cycle of length {self.period} at PC {self.pc:02X}"
+        )
+
+    def run(self, max_cycles: int, skip_waits: bool = False) -> RunResult:
+        vm = self.vm
+        if vm.observed:
+            return vm.run(max_cycles, skip_waits)
+        mem = vm.mem
+        cycle = vm.cycle
+        jmpf = VirtualMachine._op_jmpf
+        start = vm.clock
+        end = start + max_cycles
+        self.period = 0
+        saved = None
+        saved_clock = 0
+        saved_head = 0
+        sampling = True
+        power = 1
+        samples = 0
+        vm.halted = False
+        if skip_waits:
+            vm._wait_limit = end
+        try:
+            while vm.clock < end:
+                cycle()
+                if vm.halted:
+                    return RunResult(vm.clock - start, StopReason.HALT, self._pc())
+                handler, addr, _ = vm._last
+                if handler is not jmpf or not sampling:
+                    continue
+                if (mem[Register.PC] << 4) | mem[Register.PC + 1] != addr:
+                    continue
+                state = bytes(mem)
+                if state == saved:
+                    sampling = False
+                    if vm.events.head != saved_head:
+                        continue
+                    self.period = vm.clock - saved_clock
+                    self.pc = addr
+                    if self.stop_on_cycle:
+                        return RunResult(vm.clock - start, StopReason.CYCLE, addr)
+                    remaining = end - vm.clock
+                    vm.clock += remaining - remaining % self.period
+                    continue
+                samples += 1
+                if samples == power:
+                    saved = state
+                    saved_clock = vm.clock
+                    saved_head = vm.events.head
+                    power *= 2
+                    samples = 0
+            return RunResult(vm.clock - start, StopReason.BUDGET, self._pc())
+        finally:
+            vm._wait_limit = 0
+
+    def _pc(self) -> int:
+        return self.vm.get_reg(Register.PC)
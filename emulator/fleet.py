@@ -0,0 +1,146 @@
+import argparse
+import json
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from virtual_machine import VirtualMachine, Register
+from compiler import BlockCompiler
+from fastforward import FastForward
+from loader import ImageCache, load_program
+from inputscript import InputPlayer, load_script, parse_script
+
+
+DEFAULT_CONFIG = {"name": "default", "cycles": 1_000_000, "skip_waits": True}
+
+_cache: ImageCache | None = None
+
+
+def _worker_cache() -> ImageCache:
+    # One cache per worker process, shared by all of its jobs.
+    global _cache
+    if _cache is None:
+        _cache = ImageCache()
+    return _cache
+
+
+def run_job(path: str, config: dict) -> dict:
+    try:
+        program = load_program(path, _worker_cache())
+    except ValueError as e:
+        return {"image": path, "config": config["name"], "error": str(e)}
+
+    vm = VirtualMachine(program)
+    for key in config.get("keys", []):
+        vm.prese_key(key)
+
+    skip_waits = config.get("skip_waits", False)
+    period = None
+    error = None
+    begin = time.perf_counter()
+    try:
+        if config.get("engine", "interpreter") == "compiled":
+            BlockCompiler(vm).run(config["cycles"], skip_waits)
+            reason = "HALT" if vm.halted else "BUDGET"
+        elif config.get("fast_forward", False):
+            fast_forward = FastForward(vm, config.get("stop_on_cycle", False))
+            reason = fast_forward.run(config["cycles"], skip_waits).reason.name
+            period = fast_forward.period or None
+        elif "events" in config:
+            player = InputPlayer(config["events"])
+            reason = player.run(vm, config["cycles"], skip_waits).reason.name
+        else:
+            reason = vm.run(config["cycles"], skip_waits).reason.name
+    except AssertionError as e:
+        # The program did something the VM cannot execute, such as RET on
+        # an empty stack; that is this job's result, not the fleet's.
+        reason = "FAULT"
+        error = f"{vm.last_inst}: {e}" if str(e) else vm.last_inst
+    wall_time = time.perf_counter() - begin
+
+    result = {
+        "image": path,
+        "config": config["name"],
+        "cycles": vm.clock,
+        "reason": reason,
+        "registers": {register.name: vm.get_reg(register) for register in Register},
+        "numeric_led": vm.get_numeric_led(),
+        "binary_led": vm.get_binary_led(),
+        "cycle_period": period,
+        "wall_time": wall_time,
+    }
+    if error is not None:
+        result["error"] = error
+    return result
+
+
+def find_images(directory: str) -> list[str]:
+    return sorted(
+        os.path.join(directory, name)
+        for name in os.listdir(directory)
+        if name.lower().endswith((".bin", ".hex"))
+    )
+
+
+def load_configs(path: str | None, cycles: int | None) -> list[dict]:
+    if path is None:
+        configs = [dict(DEFAULT_CONFIG)]
+    else:
+        with open(path, "r") as f:
+            configs = json.load(f)
+    for i, config in enumerate(configs):
+        config.setdefault("name", f"config-{i}")
+        config.setdefault("cycles", DEFAULT_CONFIG["cycles"])
+        if cycles is not None:
+            config["cycles"] = cycles
+        if "script" in config:
+            config["events"] = _load_config_script(config, path)
+    return configs
+
+
+def _load_config_script(config: dict, path: str | None) -> list:
+    # "script" is inline text if it spans lines, otherwise a file path
+    # relative to the config file.
+    if config.get("engine", "interpreter") != "interpreter" or config.get(
+        "fast_forward", False
+    ):
+        raise ValueError(f"{config['name']}: a script needs the interpreter")
+    script = config["script"]
+    try:
+        if "\n" in script:
+            return parse_script(script)
+        return load_script(os.path.join(os.path.dirname(path or ""), script))
+    except (OSError, ValueError) as e:
+        raise ValueError(f"{config['name']}: {e}") from e
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-d", "--directory", required=True)
+    parser.add_argument("-c", "--config")
+    parser.add_argument("-o", "--output")
+    parser.add_argument("-n", "--cycles", type=int)
+    parser.add_argument("-j", "--jobs", type=int, default=os.cpu_count())
+    args = parser.parse_args()
+
+    images = find_images(args.directory)
+    try:
+        configs = load_configs(args.config, args.cycles)
+    except ValueError as e:
+        parser.error(str(e))
+
+    out = sys.stdout if args.output is None else open(args.output, "w")
+    try:
+        with ProcessPoolExecutor(max_workers=args.jobs) as executor:
+            futures = [
+                executor.submit(run_job, image, config)
+                for image in images
+                for config in configs
+            ]
+            for future in as_completed(futures):
+                out.write(json.dumps(future.result()) + "\n")
+                out.flush()
+    finally:
+        if out is not sys.stdout:
+            out.close()
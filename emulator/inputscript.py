@@ -0,0 +1,208 @@
+import math
+from dataclasses import dataclass
+from typing import Callable
+
+from virtual_machine import VirtualMachine, RunResult, StopReason
+
+
+DEFAULT_HOLD = 1
+IDLE_CHECK = 100
+
+# An input script has one action per line; "#" starts a comment.
+#
+#   <cycle> down <key>              key goes down at that clock
+#   <cycle> up <key>                key goes up at that clock
+#   <cycle> press <key> [hold]      down, then up again hold cycles later
+#   <cycle> repeat <count> <period> the lines up to the matching "end" are
+#   ...                             played count times, period cycles apart,
+#   end                             with cycles relative to <cycle>
+#
+# <cycle> is in decimal, either absolute or "+N" after the previous line;
+# keys are one hex digit. Actions at a clock are applied in script order
+# before the instruction that runs at that clock.
+
+
+@dataclass(frozen=True)
+class KeyEvent:
+    clock: int
+    key: int
+    down: bool
+
+
+def _parse_int(value: str, number: int) -> int:
+    if not value.isdigit():
+        raise ValueError(f"line {number}: invalid number {value!r}")
+    return int(value)
+
+
+def _parse_key(value: str, number: int) -> int:
+    if len(value) != 1 or value not in "0123456789abcdefABCDEF":
+        raise ValueError(f"line {number}: invalid key {value!r}")
+    return int(value, 16)
+
+
+def parse_script(text: str) -> list[KeyEvent]:
+    # Each open block is (events, start clock, count, period).
+    blocks = [([], 0, 1, 0)]
+    last = 0
+    for number, line in enumerate(text.splitlines(), 1):
+        words = line.partition("#")[0].split()
+        if not words:
+            continue
+        if words == ["end"]:
+            if len(blocks) == 1:
+                raise ValueError(f"line {number}: end without repeat")
+            events, _, count, period = blocks.pop()
+            blocks[-1][0].extend(
+                KeyEvent(event.clock + i * period, event.key, event.down)
+                for i in range(count)
+                for event in events
+            )
+            if events and count:
+                last = max(event.clock for event in events) + (count - 1) * period
+            continue
+
+        events, base, _, _ = blocks[-1]
+        cycle = words[0]
+        if cycle.startswith("+"):
+            clock = last + _parse_int(cycle[1:], number)
+        else:
+            clock = base + _parse_int(cycle, number)
+        match words[1:]:
+            case ["down", key]:
+                events.append(KeyEvent(clock, _parse_key(key, number), True))
+            case ["up", key]:
+                events.append(KeyEvent(clock, _parse_key(key, number), False))
+            case ["press", key, *hold] if len(hold) <= 1:
+                key = _parse_key(key, number)
+                length = _parse_int(hold[0], number) if hold else DEFAULT_HOLD
+                events.append(KeyEvent(clock, key, True))
+                events.append(KeyEvent(clock + length, key, False))
+            case ["repeat", count, period]:
+                count = _parse_int(count, number)
+                blocks.append(([], clock, count, _parse_int(period, number)))
+            case _:
+                raise ValueError(f"line {number}: cannot parse {line.strip()!r}")
+        last = clock
+    if len(blocks) > 1:
+        raise ValueError("repeat without end")
+    # A stable sort by clock alone keeps script order within a clock, so a
+    # zero-length press goes down before it goes up.
+    return sorted(blocks[0][0], key=lambda event: event.clock)
+
+
+def load_script(path: str) -> list[KeyEvent]:
+    with open(path, "r") as f:
+        return parse_script(f.read())
+
+
+def format_script(events: list[KeyEvent]) -> str:
+    # A down followed by an up of the same key becomes a single press.
+    lines = []
+    pending = {}
+    for event in sorted(events, key=lambda event: event.clock):
+        if event.down:
+            pending[event.key] = len(lines)
+            lines.append([event.clock, "down", event.key, None])
+        elif event.key in pending:
+            line = lines[pending.pop(event.key)]
+            line[1] = "press"
+            line[3] = event.clock - line[0]
+        else:
+            lines.append([event.clock, "up", event.key, None])
+    return "".join(
+        f"{clock} {action} {key:X}" + ("" if hold is None else f" {hold}") + "\n"
+        for clock, action, key, hold in lines
+    )
+
+
+class InputPlayer:
+    # Plays key events into a VM at exact clock values. run() drives the VM
+    # in segments of at most IDLE_CHECK cycles that end at the next event,
+    # so any run loop feature (wait skipping, breakpoints, predicates,
+    # deadlines) works unchanged. Once the program is just polling INK, the
+    # time up to the next event is skipped in whole idle periods.
+
+    def __init__(self, events: list[KeyEvent]):
+        self.events = sorted(events, key=lambda event: event.clock)
+        self.position = 0
+
+    @property
+    def next_clock(self) -> float:
+        if self.position == len(self.events):
+            return math.inf
+        return self.events[self.position].clock
+
+    def apply(self, vm: VirtualMachine) -> None:
+        events = self.events
+        applied = False
+        while self.position < len(events) and events[self.position].clock <= vm.clock:
+            event = events[self.position]
+            if event.down:
+                vm.prese_key(event.key)
+            else:
+                vm.release_key(event.key)
+            self.position += 1
+            applied = True
+        if applied:
+            # A released key changes what the program polls as much as a
+            # pressed one does.
+            vm.reset_idle()
+
+    def run(
+        self,
+        vm: VirtualMachine,
+        max_cycles: int,
+        skip_waits: bool = False,
+        predicate: Callable[[VirtualMachine], bool] | None = None,
+        check_every: int = 1,
+        deadline: float | None = None,
+    ) -> RunResult:
+        start = vm.clock
+        end = start + max_cycles
+        while True:
+            self.apply(vm)
+            target = min(end, self.next_clock)
+            if vm.idle_period:
+                vm.skip_idle(target - vm.clock)
+            cycles = min(target - vm.clock, IDLE_CHECK)
+            result = vm._run(cycles, predicate, check_every, deadline, skip_waits)
+            if result.reason != StopReason.BUDGET or vm.clock >= end:
+                self.apply(vm)
+                return RunResult(vm.clock - start, result.reason, result.pc)
+
+
+class InputRecorder:
+    # Collects key events from a live session. If the clock goes backwards,
+    # e.g. after stepping back, everything recorded after it is dropped.
+
+    def __init__(self):
+        self.events: list[KeyEvent] = []
+        self._held: set[int] = set()
+
+    def press(self, clock: int, key: int) -> None:
+        self._truncate(clock)
+        self._held.add(key)
+        self.events.append(KeyEvent(clock, key, True))
+
+    def release(self, clock: int, key: int) -> None:
+        if key in self._held:
+            self._truncate(clock)
+            self._held.discard(key)
+            self.events.append(KeyEvent(clock, key, False))
+
+    def release_all(self, clock: int) -> None:
+        for key in sorted(self._held):
+            self.release(clock, key)
+
+    def script(self) -> str:
+        return format_script(self.events)
+
+    def save(self, path: str) -> None:
+        with open(path, "w") as f:
+            f.write(self.script())
+
+    def _truncate(self, clock: int) -> None:
+        while self.events and self.events[-1].clock > clock:
+            self.events.pop()
+
@@ -0,0 +1,198 @@
+import hashlib
+import io
+import itertools
+import os
+from typing import Iterable
+
+
+IMAGE_SIZE = 0x80
+CACHE_VERSION = 2
+
+_HEX_DIGITS = frozenset("0123456789abcdefABCDEF")
+_NIBBLES = bytes.maketrans(
+    b"0123456789abcdefABCDEF", bytes(range(0x10)) + bytes(range(0xA, 0x10))
+)
+
+
+def pack(nibbles: bytes) -> bytes:
+    return bytes((nibbles[i] << 4) | nibbles[i + 1] for i in range(0, 0x100, 2))
+
+
+def unpack(image: bytes) -> bytes:
+    nibbles = bytearray(0x100)
+    nibbles[0::2] = bytes(byte >> 4 for byte in image)
+    nibbles[1::2] = bytes(byte & 0xF for byte in image)
+    return bytes(nibbles)
+
+
+def parse_ide_hex(lines: Iterable[str], name: str = "<hex>") -> bytes:
+    # IDE output: one "<tag><address>:<nibbles>" line per run of memory,
+    # with the address in nibbles. Returns the 0x100 nibbles, which a VM
+    # takes as they are.
+    nibbles = bytearray(0x100)
+    for number, line in enumerate(lines, 1):
+        line = line.strip()
+        if not line:
+            continue
+        addr, sep, data = line.partition(":")
+        if not sep or len(addr) < 2:
+            raise ValueError(f"{name}:{number}: expected <tag><address>:<nibbles>")
+        if not set(addr[1:]) <= _HEX_DIGITS:
+            raise ValueError(f"{name}:{number}: invalid address {addr[1:]!r}")
+        if not set(data) <= _HEX_DIGITS:
+            bad = next(c for c in data if c not in _HEX_DIGITS)
+            raise ValueError(f"{name}:{number}: invalid nibble {bad!r}")
+        begin = int(addr[1:], 16)
+        if begin + len(data) > 0x100:
+            raise ValueError(f"{name}:{number}: data runs past address 0xFF")
+        nibbles[begin : begin + len(data)] = data.encode().translate(_NIBBLES)
+    return bytes(nibbles)
+
+
+def parse_intel_hex(lines: Iterable[str], name: str = "<hex>") -> bytes:
+    # Intel HEX with the packed image bytes as data; only data and
+    # end-of-file records are accepted.
+    image = bytearray(IMAGE_SIZE)
+    number = 0
+    for number, line in enumerate(lines, 1):
+        line = line.strip()
+        if not line:
+            continue
+        if not line.startswith(":"):
+            raise ValueError(f"{name}:{number}: record does not start with ':'")
+        try:
+            record = bytes.fromhex(line[1:])
+        except ValueError:
+            raise ValueError(f"{name}:{number}: invalid hex digits") from None
+        if len(record) < 5 or len(record) != record[0] + 5:
+            raise ValueError(f"{name}:{number}: record length does not match")
+        if sum(record) & 0xFF:
+            raise ValueError(f"{name}:{number}: checksum mismatch")
+        addr = (record[1] << 8) | record[2]
+        data = record[4:-1]
+        match record[3]:
+            case 0x00:
+                if addr + len(data) > IMAGE_SIZE:
+                    raise ValueError(f"{name}:{number}: data runs past the image")
+                image[addr : addr + len(data)] = data
+            case 0x01:
+                return bytes(image)
+            case kind:
+                raise ValueError(f"{name}:{number}: unsupported record type {kind:02X}")
+    raise ValueError(f"{name}:{number}: missing end-of-file record")
+
+
+def parse_hex(lines: Iterable[str], name: str = "<hex>") -> bytes:
+    lines = iter(lines)
+    blank = []
+    for line in lines:
+        blank.append(line)
+        if line.strip():
+            break
+    lines = itertools.chain(blank, lines)
+    # Both formats come back as nibbles.
+    if blank and blank[-1].lstrip().startswith(":"):
+        return unpack(parse_intel_hex(lines, name))
+    return parse_ide_hex(lines, name)
+
+
+class ImageCache:
+    # Parsed programs, as nibbles, keyed by a hash of the source file, so a
+    # program that has not changed since the last run is not parsed again.
+    # Entries are written to a temporary file and renamed, so concurrent runs
+    # can share a cache. The directory is only created when the first entry
+    # is stored, and a cache that cannot be read or written, e.g. under a
+    # read-only home, just never hits.
+
+    def __init__(self, directory: str | None = None):
+        if directory is None:
+            base = os.environ.get("XDG_CACHE_HOME") or os.path.expanduser("~/.cache")
+            directory = os.path.join(base, "orange4-emulator", "images")
+        self.directory = directory
+
+    def get(self, source: bytes) -> bytes | None:
+        try:
+            with open(self._path(source), "rb") as f:
+                image = f.read()
+        except OSError:
+            return None
+        return image if len(image) == 0x100 else None
+
+    def put(self, source: bytes, image: bytes) -> None:
+        path = self._path(source)
+        temp = f"{path}.{os.getpid()}.tmp"
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            with open(temp, "wb") as f:
+                f.write(image)
+            os.replace(temp, path)
+        except OSError:
+            pass
+
+    def _path(self, source: bytes) -> str:
+        digest = hashlib.sha256(bytes([CACHE_VERSION]) + source).hexdigest()
+        return os.path.join(self.directory, digest + ".bin")
+
+
+def is_hex(path: str) -> bool:
+    return path.lower().endswith(".hex")
+
+
+def load_hex(path: str, cache: ImageCache | None = None) -> bytes:
+    # Parses path as hex whatever its name, into nibbles.
+    with open(path, "rb") as f:
+        source = f.read()
+    if cache is not None:
+        image = cache.get(source)
+        if image is not None:
+            return image
+    try:
+        text = source.decode("ascii")
+    except UnicodeDecodeError:
+        raise ValueError(f"{path}: not a text file") from None
+    image = parse_hex(io.StringIO(text), path)
+    if cache is not None:
+        cache.put(source, image)
+    return image
+
+
+def load_image(path: str, cache: ImageCache | None = None) -> bytes:
+    # The packed image: .hex files are parsed, anything else is taken as a
+    # packed image already.
+    if is_hex(path):
+        return pack(load_hex(path, cache))
+    with open(path, "rb") as f:
+        image = f.read()
+    if len(image) != IMAGE_SIZE:
+        raise ValueError(f"{path}: image must be 0x80 bytes, not {len(image)}")
+    return image
+
+
+def load_program(path: str, cache: ImageCache | None = None) -> bytes:
+    # The nibbles to load into a VM; a parsed .hex file goes in as it is.
+    if is_hex(path):
+        return load_hex(path, cache)
+    return unpack(load_image(path))
+
+
+def convert_directory(
+    source: str, destination: str, cache: ImageCache | None = None
+) -> tuple[list[str], list[str]]:
+    # Converts every .hex file in source to a .bin in destination; returns
+    # the files written and the errors of the ones that failed.
+    os.makedirs(destination, exist_ok=True)
+    written = []
+    errors = []
+    for name in sorted(os.listdir(source)):
+        if not is_hex(name):
+            continue
+        try:
+            image = pack(load_hex(os.path.join(source, name), cache))
+        except ValueError as e:
+            errors.append(str(e))
+            continue
+        path = os.path.join(destination, os.path.splitext(name)[0] + ".bin")
+        with open(path, "wb") as f:
+            f.write(image)
+        written.append(path)
+    return written, errors
@@ -1,9 +1,18 @@
+import functools
+import queue
 import re
 import threading
+import time
 
+from rich.segment import Segment
+from rich.style import Style
 from textual.app import App, ComposeResult
+from textual.events import Click
+from textual.geometry import Region
+from textual.message import Message
 from textual.reactive import reactive
 from textual.containers import Container
+from textual.strip import Strip
 from textual.widget import Widget
 from textual.widgets import (
     Header,
@@ -12,9 +21,61 @@ from textual.widgets import (
     Label,
     Static,
     Button,
+    Input,
+    Select,
 )
 
-from virtual_machine import VirtualMachine, Register
+from virtual_machine import (
+    VirtualMachine,
+    VMState,
+    SystemLayout,
+    Register,
+    Opcode,
+    BreakpointHit,
+    changed_addrs,
+)
+from rewind import RewindBuffer
+from profiler import Profiler
+from debugger import Debugger, Hit
+from events import Event, EventKind, format_event
+from scheduler import Scheduler
+from inputscript import InputRecorder
+
+
+FRAME_RATE = 60
+
+SPEEDS = [
+    ("1/100x", 0.01),
+    ("1/10x", 0.1),
+    ("1/2x", 0.5),
+    ("1x", 1.0),
+    ("2x", 2.0),
+    ("10x", 10.0),
+    ("Turbo", "turbo"),
+]
+
+_REGISTERS = {
+    "a": Register.A,
+    "b": Register.B,
+    "y": Register.Y,
+    "z": Register.Z,
+    "a2": Register.A2,
+    "b2": Register.B2,
+    "y2": Register.Y2,
+    "z2": Register.Z2,
+    "f": Register.F,
+    "pc": Register.PC,
+    "sp": Register.SP,
+}
+
+
+def _frame_reg(mem: bytes, register: Register) -> int:
+    # VirtualMachine.get_reg's encoding, read from a published frame.
+    if register == Register.PC or register == Register.SP:
+        return (mem[register] << 4) | mem[register + 1]
+    if register == Register.F:
+        return (mem[register] >> 3) & 0x1
+    return mem[register]
 
 
 class Board(Static):
@@ -116,19 +177,14 @@ class VirtualMachineController(Static):
         }
         #virtual_machine_controller {
             layout: grid;
-            grid-size: 3 3;
+            grid-size: 4 3;
             align: center middle;
             grid-rows: 16 3;
             grid-gutter: 1;
         }
         #memory_view {
-            column-span: 2;
+            column-span: 3;
             row-span: 1;
-            layout: grid;
-            grid-size: 17 16;
-            grid-gutter: 0 1;
-            grid-columns: 3 1 1 1 1 1 1 1 1 1 1 1 1 1 1 1 1;
-            width: 35;
         }
         #register_view {
             column-span: 1;
@@ -139,15 +195,113 @@ class VirtualMachineController(Static):
             width: 6;
         }
         LastInst {
-            column-span: 3;
+            column-span: 4;
         }
     """
 
-    class MemoryItem(Widget):
-        value = reactive(0, always_update=True)
+    class MemoryView(Widget):
+        # One widget for the whole 16x16 nibble grid. Each row is rendered to
+        # a Strip that is cached until something on that row changes, and
+        # only the rows that changed are refreshed.
 
-        def render(self) -> str:
-            return f"{self.value:X}"
+        DEFAULT_CSS = """
+        MemoryView {
+            width: 35;
+            height: 16;
+        }
+        """
+
+        HEAT_LEVELS = 8
+        PC_STYLE = Style(color="black", bgcolor="green", bold=True)
+        SP_STYLE = Style(color="black", bgcolor="cyan")
+        CHANGED_STYLE = Style(color="yellow", bold=True)
+        BREAKPOINT_STYLE = Style(reverse=True)
+
+        class Clicked(Message):
+            def __init__(self, addr: int):
+                super().__init__()
+                self.addr = addr
+
+        def __init__(self, id: str | None = None):
+            super().__init__(id=id)
+            self._mem = bytes(0x100)
+            self._changed: set[int] = set()
+            self._heat = [0] * 0x100
+            self._breakpoints: set[int] = set()
+            self._pc = 0
+            self._sp = 0
+            self._lines: list[Strip | None] = [None] * 0x10
+
+        def update_memory(self, mem: bytes, changes: list[int]) -> None:
+            if not changes:
+                return
+            rows = {addr >> 4 for addr in self._changed.union(changes)}
+            pc = (mem[Register.PC] << 4) | mem[Register.PC + 1]
+            sp = (mem[Register.SP] << 4) | mem[Register.SP + 1]
+            if pc != self._pc:
+                rows |= {self._pc >> 4, pc >> 4}
+            if sp != self._sp:
+                rows |= {self._sp >> 4, sp >> 4}
+            self._mem = mem
+            self._changed = set(changes)
+            self._pc = pc
+            self._sp = sp
+            self._invalidate(rows)
+
+        def update_heat(self, heat: list[int]) -> None:
+            rows = {
+                addr >> 4 for addr in range(0x100) if heat[addr] != self._heat[addr]
+            }
+            self._heat = list(heat)
+            self._invalidate(rows)
+
+        def update_breakpoints(self, breakpoints) -> None:
+            breakpoints = set(breakpoints)
+            rows = {addr >> 4 for addr in breakpoints ^ self._breakpoints}
+            self._breakpoints = breakpoints
+            self._invalidate(rows)
+
+        def render_line(self, y: int) -> Strip:
+            if y >= 0x10:
+                return Strip.blank(self.size.width)
+            line = self._lines[y]
+            if line is None:
+                line = self._lines[y] = self._render_row(y)
+            return line
+
+        def on_click(self, event: Click) -> None:
+            col, gap = divmod(event.x - 4, 2)
+            if 0 <= event.y < 0x10 and 0 <= col < 0x10 and gap == 0:
+                self.post_message(self.Clicked((event.y << 4) | col))
+
+        def _render_row(self, row: int) -> Strip:
+            segments = [Segment(f"{row << 4:02X}: ")]
+            for addr in range(row << 4, (row + 1) << 4):
+                segments.append(Segment(f"{self._mem[addr]:X}", self._style(addr)))
+                segments.append(Segment(" "))
+            return Strip(segments[:-1])
+
+        def _style(self, addr: int) -> Style:
+            style = Style()
+            heat = self._heat[addr]
+            if heat:
+                level = heat / self.HEAT_LEVELS
+                style += Style(bgcolor=f"rgb({int(255 * level)},{int(64 * level)},0)")
+            if addr in self._changed:
+                style += self.CHANGED_STYLE
+            if addr == self._sp:
+                style += self.SP_STYLE
+            if addr == self._pc:
+                style += self.PC_STYLE
+            if addr in self._breakpoints:
+                style += self.BREAKPOINT_STYLE
+            return style
+
+        def _invalidate(self, rows) -> None:
+            width = self.size.width
+            for row in rows:
+                self._lines[row] = None
+                self.refresh(Region(0, row, width, 1))
 
     class RegisterItem(Widget):
         reg = reactive("")
@@ -173,18 +327,12 @@ class VirtualMachineController(Static):
         def render(self) -> str:
             return f"LAST: {self.value}"
 
-    _mem_elems: list[MemoryItem] = []
+    _mem_elem = None
     _reg_elems: list[RegisterItem] = []
     _last_inst_elem = None
 
     def compose(self) -> ComposeResult:
-        memory_labels = []
-        for i in range(0x10):
-            memory_labels.append(Static(f"{i << 4:02X}:"))
-            for j in range(0x10):
-                elem = self.MemoryItem(id=f"mem-{i:x}-{j:x}")
-                memory_labels.append(elem)
-                self._mem_elems.append(elem)
+        self._mem_elem = self.MemoryView(id="memory_view")
         self._reg_elems = {
             "a": self.RegisterItem(reg="A", id="reg-a"),
             "b": self.RegisterItem(reg="B", id="reg-b"),
@@ -200,19 +348,24 @@ class VirtualMachineController(Static):
         }
         self._last_inst_elem = self.LastInst()
         yield Container(
-            Container(*memory_labels, id="memory_view"),
+            self._mem_elem,
             Container(*self._reg_elems.values(), id="register_view"),
             self._last_inst_elem,
+            Button("BACK", id="btn-ctrl-back", variant="primary"),
             Button("STEP", id="btn-ctrl-step", variant="primary"),
             Button("RUN", id="btn-ctrl-run", variant="primary"),
             Button("STOP", id="btn-ctrl-stop", variant="primary"),
             id="virtual_machine_controller",
         )
 
-    def update_memory(self, mem) -> None:
-        for i in range(0x10):
-            for j in range(0x10):
-                self._mem_elems[i * 0x10 + j].value = mem[i * 0x10 + j]
+    def update_memory(self, mem, changes) -> None:
+        self._mem_elem.update_memory(mem, changes)
+
+    def update_heat(self, heat) -> None:
+        self._mem_elem.update_heat(heat)
+
+    def update_breakpoints(self, breakpoints) -> None:
+        self._mem_elem.update_breakpoints(breakpoints)
 
     def update_register(self, name, value) -> None:
         self._reg_elems[name].value = value
@@ -251,8 +404,14 @@ class MonitorPane(Static):
     def set_binary_led_value(self, value: int):
         self._board_elem.update_binary_led(value)
 
-    def set_memory(self, mem):
-        self._controller_elem.update_memory(mem)
+    def set_memory(self, mem, changes):
+        self._controller_elem.update_memory(mem, changes)
+
+    def set_heat(self, heat):
+        self._controller_elem.update_heat(heat)
+
+    def set_breakpoints(self, breakpoints):
+        self._controller_elem.update_breakpoints(breakpoints)
 
     def set_register(self, name, value):
         self._controller_elem.update_register(name, value)
@@ -261,6 +420,64 @@ class MonitorPane(Static):
         self._controller_elem.update_last_inst(value)
 
 
+class ConfigPane(Static):
+    DEFAULT_CSS = """
+    ConfigPane {
+        width: 1fr;
+        height: 1fr;
+    }
+    #config_pane {
+        layout: grid;
+        grid-size: 2 3;
+        grid-columns: 12 24;
+        grid-rows: 3;
+        grid-gutter: 1;
+    }
+    ConfigPane Label {
+        height: 3;
+        content-align: left middle;
+    }
+    """
+
+    def __init__(self, hz: int, speed: float | None):
+        super().__init__()
+        self._hz = hz
+        self._speed = "turbo" if speed is None else speed
+        self._status_elem = None
+
+    def compose(self) -> ComposeResult:
+        self._status_elem = Label("", id="config-status")
+        speeds = SPEEDS
+        if all(speed != self._speed for _, speed in SPEEDS):
+            # A --speed that is not a preset is offered alongside them.
+            custom = (f"{self._speed:g}x", self._speed)
+            presets = sorted([*SPEEDS[:-1], custom], key=lambda option: option[1])
+            speeds = presets + SPEEDS[-1:]
+        yield Container(
+            Label("Clock (Hz)"),
+            Input(str(self._hz), type="integer", id="config-hz"),
+            Label("Speed"),
+            Select(speeds, allow_blank=False, value=self._speed, id="config-speed"),
+            Label("Achieved"),
+            self._status_elem,
+            id="config_pane",
+        )
+
+    def rate(self) -> tuple[int, float | None]:
+        # An unfinished value such as "-" reads as 0, which is rejected, so
+        # the previous rate stays in effect.
+        hz = self.query_one("#config-hz", Input).value
+        speed = self.query_one("#config-speed", Select).value
+        try:
+            hz = int(hz)
+        except ValueError:
+            hz = 0
+        return hz, None if speed == "turbo" else speed
+
+    def set_status(self, value: str):
+        self._status_elem.update(value)
+
+
 class VirtualMachineMonitor(App):
     BINDINGS = [("q", "quit", "Quit")]
     CSS = """
@@ -270,71 +487,188 @@ class VirtualMachineMonitor(App):
     """
 
     _monitor_pane = None
-
-    def __init__(self, vm: VirtualMachine):
+    _config_pane = None
+
+    def __init__(
+        self,
+        vm: VirtualMachine,
+        rewind: RewindBuffer | None = None,
+        profiler: Profiler | None = None,
+        debugger: Debugger | None = None,
+        scheduler: Scheduler | None = None,
+        recorder: InputRecorder | None = None,
+    ):
         super().__init__()
         self.vm = vm
+        self.rewind = rewind
+        if rewind is not None:
+            rewind.attach(vm)
+        self.profiler = profiler
+        if profiler is not None:
+            profiler.attach(vm)
+        self.debugger = debugger
+        if scheduler is None:
+            scheduler = Scheduler(vm.HZ, frame_rate=FRAME_RATE)
+        self.scheduler = scheduler
+        self.recorder = recorder
+        vm.events.subscribe(self._on_events)
         self.vm_thread = None
         self.vm_thread_event = threading.Event()
-        self.vm_lock = threading.Lock()
+        self.vm_idle = threading.Condition()
+        self.commands = queue.SimpleQueue()
+        self.frame: VMState = vm.snapshot()
+        self._shown: VMState | None = None
+        self._status = ""
+        # Why the run thread last stopped on its own: a Hit or a VM fault.
+        self._stopped: Hit | AssertionError | None = None
 
     def step(self):
         self.vm.set_wait_count(0)
-        self.vm.cycle()
-        self.vm.release_all_key()
+        if self.debugger is not None:
+            self.debugger.resume()
+        try:
+            self._cycle()
+        except AssertionError as e:
+            self._notify_fault(e)
+        self._publish()
         self.update()
 
+    def step_back(self):
+        if self.rewind is not None:
+            self.rewind.step_back(self.vm)
+            self._publish()
+            self.update()
+
     def compose(self) -> ComposeResult:
         self._monitor_pane = MonitorPane()
+        self._config_pane = ConfigPane(self.scheduler.hz, self.scheduler.speed)
         yield Header()
         with TabbedContent("Monitor", "Config"):
             yield self._monitor_pane
-            yield Label("config")
+            yield self._config_pane
         yield Footer()
 
     def on_mount(self) -> None:
+        if self.debugger is not None:
+            self._monitor_pane.set_breakpoints(self.debugger.breakpoints)
         self.update()
-        self.set_interval(1 / 60, self.update)
+        self.set_interval(1 / FRAME_RATE, self.update)
 
     def update(self) -> None:
-        with self.vm_lock:
-            num_led = self.vm.get_numeric_led()
-            bin_led = self.vm.get_binary_led()
-
-            mem = [0] * 0x100
-            for i in range(0x100):
-                if i % 2 == 0:
-                    mem[i] = (self.vm.data[i // 2] >> 4) & 0xF
-                else:
-                    mem[i] = self.vm.data[i // 2] & 0xF
-
-            reg_a = self.vm.get_reg(Register.A)
-            reg_b = self.vm.get_reg(Register.B)
-            reg_y = self.vm.get_reg(Register.Y)
-            reg_z = self.vm.get_reg(Register.Z)
-            reg_a2 = self.vm.get_reg(Register.A2)
-            reg_b2 = self.vm.get_reg(Register.B2)
-            reg_y2 = self.vm.get_reg(Register.Y2)
-            reg_z2 = self.vm.get_reg(Register.Z2)
-            reg_f = self.vm.get_reg(Register.F)
-            reg_pc = self.vm.get_reg(Register.PC)
-            reg_sp = self.vm.get_reg(Register.SP)
-
-        self._monitor_pane.set_numeric_led_value(num_led)
-        self._monitor_pane.set_binary_led_value(bin_led)
-        self._monitor_pane.set_memory(mem)
-        self._monitor_pane.set_register("a", reg_a)
-        self._monitor_pane.set_register("b", reg_b)
-        self._monitor_pane.set_register("y", reg_y)
-        self._monitor_pane.set_register("z", reg_z)
-        self._monitor_pane.set_register("a2", reg_a2)
-        self._monitor_pane.set_register("b2", reg_b2)
-        self._monitor_pane.set_register("y2", reg_y2)
-        self._monitor_pane.set_register("z2", reg_z2)
-        self._monitor_pane.set_register("f", reg_f)
-        self._monitor_pane.set_register("pc", reg_pc)
-        self._monitor_pane.set_register("sp", reg_sp)
-        self._monitor_pane.set_last_inst(self.vm.last_inst)
+        if self.vm_thread is not None and not self.vm_thread.is_alive():
+            self._stop()
+            match self._stopped:
+                case Hit() as hit:
+                    self._notify_hit(hit)
+                case AssertionError() as fault:
+                    self._notify_fault(fault)
+
+        self._update_status()
+        self.vm.events.drain()
+
+        # Only the published frame is read here; the VM itself belongs to the
+        # worker thread while it runs.
+        frame = self.frame
+        if frame is self._shown:
+            return
+        if self._shown is None:
+            changes = list(range(0x100))
+        else:
+            changes = changed_addrs(self._shown.mem, frame.mem)
+        self._shown = frame
+        if self.debugger is not None:
+            self._monitor_pane.set_breakpoints(self.debugger.breakpoints)
+
+        mem = frame.mem
+        changed = set(changes)
+        registers = {
+            name: _frame_reg(mem, register)
+            for name, register in _REGISTERS.items()
+            if register in changed or register + 1 in changed
+        }
+        num_led = None
+        if SystemLayout.NUMERIC_LED in changed:
+            num_led = mem[SystemLayout.NUMERIC_LED]
+        bin_led = None
+        if changed & {SystemLayout.BINARY_LED, SystemLayout.BINARY_LED + 1}:
+            bin_led = mem[SystemLayout.BINARY_LED] | (
+                mem[SystemLayout.BINARY_LED + 1] << 4
+            )
+
+        heat = None
+        if self.profiler is not None:
+            heat = self.profiler.heat_map(
+                VirtualMachineController.MemoryView.HEAT_LEVELS
+            )
+
+        if num_led is not None:
+            self._monitor_pane.set_numeric_led_value(num_led)
+        if bin_led is not None:
+            self._monitor_pane.set_binary_led_value(bin_led)
+        self._monitor_pane.set_memory(frame.mem, changes)
+        if heat is not None:
+            self._monitor_pane.set_heat(heat)
+        for name, value in registers.items():
+            self._monitor_pane.set_register(name, value)
+        self._monitor_pane.set_last_inst(frame.last_inst)
+
+    def _update_status(self) -> None:
+        target = self.scheduler.target_hz
+        target = "turbo" if target is None else f"{target:g} Hz"
+        if self.vm_thread is None:
+            status = f"stopped, target {target}"
+        else:
+            status = f"{self.scheduler.achieved_hz:.0f} Hz, target {target}"
+        if status != self._status:
+            self._status = status
+            self.sub_title = status
+            self._config_pane.set_status(status)
+
+    def _on_events(self, events: list[Event]) -> None:
+        if any(event.kind == EventKind.BEEP for event in events):
+            self.bell()
+        warnings = dict.fromkeys(
+            format_event(event)
+            for event in events
+            if event.kind in (EventKind.IO, EventKind.UNIMPLEMENTED)
+        )
+        for message in warnings:
+            self.notify(message, severity="warning")
+
+    def _notify_hit(self, hit: Hit) -> None:
+        message = f"{hit.kind.name} at {hit.pc:02X}"
+        if hit.addr is not None:
+            message += f" on {hit.addr:02X}"
+        self.notify(message, title="BREAK")
+
+    def _notify_fault(self, fault: AssertionError) -> None:
+        message = f"{self.vm.last_inst} at clock {self.vm.clock}"
+        if str(fault):
+            message += f": {fault}"
+        self.notify(message, title="FAULT", severity="error")
+
+    def on_memory_view_clicked(self, event) -> None:
+        if self.debugger is not None:
+            self._post(functools.partial(self.debugger.toggle_breakpoint, event.addr))
+
+    def on_input_submitted(self, event: Input.Submitted) -> None:
+        if event.input.id == "config-hz":
+            self._set_rate()
+
+    def on_select_changed(self, event: Select.Changed) -> None:
+        if event.select.id == "config-speed":
+            self._set_rate()
+
+    def _set_rate(self) -> None:
+        # Both values come from the widgets, since the scheduler itself may
+        # not have applied an earlier change yet.
+        hz, speed = self._config_pane.rate()
+        if 0 < hz <= VirtualMachine.MAX_HZ:
+            self._post(functools.partial(self._apply_rate, hz, speed))
+        else:
+            self.notify(
+                f"clock must be 1 to {VirtualMachine.MAX_HZ} Hz", severity="error"
+            )
 
     def action_quit(self) -> None:
         self._stop()
@@ -343,10 +677,13 @@ class VirtualMachineMonitor(App):
     def on_button_pressed(self, event: Button.Pressed):
         if re.match(r"^btn-[0-9a-f]$", event.button.id):
             val = int(event.button.id[4:], 16)
-            self.vm.prese_key(val)
+            self._post(functools.partial(self._press, val))
         elif re.match(r"^btn-ctrl-", event.button.id):
             cmd = event.button.id[9:]
             match cmd:
+                case "back":
+                    if self.vm_thread is None:
+                        self.step_back()
                 case "step":
                     if self.vm_thread is None:
                         self.step()
@@ -368,19 +705,100 @@ class VirtualMachineMonitor(App):
 
     def _start(self):
         if self.vm_thread is None:
+            if self.debugger is not None:
+                self.debugger.resume()
+            self._stopped = None
             self.vm_thread = threading.Thread(target=self._run)
             self.vm_thread.start()
 
     def _stop(self):
         if self.vm_thread is not None:
-            self.vm_thread_event.set()
+            with self.vm_idle:
+                self.vm_thread_event.set()
+                self.vm_idle.notify_all()
             self.vm_thread.join()
             self.vm_thread = None
             self.vm_thread_event.clear()
 
+    def _post(self, command) -> None:
+        # Anything that touches the VM from the UI goes through here. While
+        # the worker runs, commands are queued and applied between chunks.
+        if self.vm_thread is None:
+            command()
+            self._publish()
+            return
+        with self.vm_idle:
+            self.commands.put(command)
+            self.vm_idle.notify_all()
+
+    def _apply_rate(self, hz: int, speed: float | None) -> None:
+        self.vm.set_hz(hz)
+        self.scheduler.set_rate(hz, speed)
+
+    def _press(self, key: int) -> None:
+        self.vm.prese_key(key)
+        if self.recorder is not None:
+            self.recorder.press(self.vm.clock, key)
+
+    def _apply_commands(self) -> bool:
+        applied = False
+        while not self.commands.empty():
+            self.commands.get()()
+            applied = True
+        return applied
+
+    def _publish(self) -> None:
+        self.frame = self.vm.snapshot()
+
     def _run(self):
+        try:
+            self._run_bursts()
+        except BreakpointHit as e:
+            self._stopped = e.args[0]
+        except AssertionError as e:
+            self._stopped = e
+        self._publish()
+
+    def _run_bursts(self):
+        # Runs the cycles the scheduler says are due, publishes one snapshot
+        # per burst and sleeps until the next one.
+        vm = self.vm
+        scheduler = self.scheduler
+        scheduler.start(vm.clock)
         while not self.vm_thread_event.is_set():
-            with self.vm_lock:
-                self.vm.cycle()
-                self.vm.release_all_key()
-            self.vm_thread_event.wait(1 / self.vm.HZ)
+            applied = self._apply_commands()
+            begin = vm.clock
+            target = scheduler.target(begin)
+            while vm.clock < target and not vm.idle_period:
+                self._cycle()
+                vm.skip_wait()
+            if applied or vm.clock != begin:
+                self._publish()
+            if vm.idle_period:
+                self._park()
+                continue
+            self.vm_thread_event.wait(scheduler.delay(vm.clock))
+
+    def _cycle(self):
+        # Key presses are held until an INK has read them.
+        vm = self.vm
+        pc = vm.get_reg(Register.PC)
+        ink = not vm.waiting and vm.get_mem(pc) == Opcode.INK
+        vm.cycle()
+        if ink:
+            vm.release_all_key()
+            if self.recorder is not None:
+                self.recorder.release_all(vm.clock)
+
+    def _park(self):
+        # The program is polling INK with nothing changing, so sleep until a
+        # key press or STOP and then account for the time as whole loops.
+        begin = time.monotonic()
+        period = self.vm.idle_period
+        with self.vm_idle:
+            self.vm_idle.wait_for(
+                lambda: not self.commands.empty() or self.vm_thread_event.is_set()
+            )
+        cycles = self.scheduler.cycles_for(time.monotonic() - begin)
+        self.vm.skip_idle(cycles, period)
+        self.scheduler.resync(self.vm.clock)
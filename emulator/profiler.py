@@ -0,0 +1,227 @@
+import argparse
+import json
+import math
+from dataclasses import asdict, dataclass
+
+from virtual_machine import (
+    VirtualMachine,
+    Register,
+    Opcode,
+    ServiceCall,
+    format_inst,
+)
+from loader import load_program
+
+
+MAX_CALL_DEPTH = 0x40
+
+
+@dataclass(frozen=True)
+class CallStats:
+    target: int
+    calls: int
+    cycles: int
+
+
+@dataclass(frozen=True)
+class LoopStats:
+    begin: int
+    end: int
+    iterations: int
+    instructions: int
+
+
+@dataclass(frozen=True)
+class Profile:
+    cycles: int
+    wait_cycles: int
+    pc_hits: tuple[int, ...]
+    instructions: dict[int, str]
+    opcodes: dict[str, int]
+    services: dict[str, int]
+    calls: list[CallStats]
+    loops: list[LoopStats]
+
+    def hot_pcs(self, count: int = 10) -> list[tuple[int, int]]:
+        hits = sorted(enumerate(self.pc_hits), key=lambda item: -item[1])
+        return [(pc, n) for pc, n in hits[:count] if n]
+
+    def to_dict(self) -> dict:
+        profile = asdict(self)
+        profile["pc_hits"] = list(self.pc_hits)
+        profile["instructions"] = {
+            f"{pc:02X}": inst for pc, inst in self.instructions.items()
+        }
+        return profile
+
+    def format(self, count: int = 10) -> str:
+        lines = [f"cycles: {self.cycles} (waiting: {self.wait_cycles})", ""]
+        lines.append("hot addresses:")
+        for pc, n in self.hot_pcs(count):
+            lines.append(f"  {pc:02X}: {n:>10}  {self.instructions.get(pc, '')}")
+        lines.append("")
+        lines.append("opcodes:")
+        for name, n in sorted(self.opcodes.items(), key=lambda item: -item[1]):
+            lines.append(f"  {name:<24} {n:>10}")
+        if self.services:
+            lines.append("")
+            lines.append("service calls:")
+            for name, n in sorted(self.services.items(), key=lambda item: -item[1]):
+                lines.append(f"  {name:<24} {n:>10}")
+        if self.calls:
+            lines.append("")
+            lines.append("calls:")
+            for call in self.calls[:count]:
+                lines.append(
+                    f"  {call.target:02X}: {call.calls:>10} calls"
+                    f" {call.cycles:>10} cycles"
+                )
+        if self.loops:
+            lines.append("")
+            lines.append("hot loops:")
+            for loop in self.loops[:count]:
+                lines.append(
+                    f"  {loop.begin:02X}-{loop.end:02X}: {loop.iterations:>10}"
+                    f" iterations {loop.instructions:>10} instructions"
+                )
+        return "\n".join(lines)
+
+
+def _opcode_name(opcode: int) -> str:
+    if opcode in Opcode._value2member_map_:
+        return Opcode(opcode).name
+    return f"EX_{opcode & 0xFF:02X}"
+
+
+def _service_name(srv: int) -> str:
+    if srv in ServiceCall._value2member_map_:
+        return ServiceCall(srv).name
+    return f"SRV_{srv:X}"
+
+
+class Profiler:
+    def __init__(self):
+        self.reset()
+
+    def reset(self) -> None:
+        self.pc_hits = [0] * 0x100
+        self.wait_cycles = 0
+        self._insts = [None] * 0x100
+        self._opcodes: dict[int, int] = {}
+        self._services = [0] * 0x10
+        self._calls: dict[int, list[int]] = {}
+        self._loops: dict[tuple[int, int], int] = {}
+        self._stack: list[tuple[int, int]] = []
+        self._cycles = 0
+        self._pc = 0
+        self._clock = 0
+        self._waiting = False
+
+    def attach(self, vm: VirtualMachine) -> None:
+        vm.add_observer(self)
+
+    def detach(self, vm: VirtualMachine) -> None:
+        vm.remove_observer(self)
+
+    def before_cycle(self, vm: VirtualMachine) -> None:
+        mem = vm.mem
+        self._waiting = vm.waiting
+        self._pc = (mem[Register.PC] << 4) | mem[Register.PC + 1]
+        self._clock = vm.clock
+
+    def after_cycle(self, vm: VirtualMachine) -> None:
+        self._cycles += vm.clock - self._clock
+        if self._waiting:
+            self.wait_cycles += vm.clock - self._clock
+            return
+        pc = self._pc
+        inst = vm._last
+        handler, operand, _ = inst
+        self.pc_hits[pc] += 1
+        self._insts[pc] = inst
+        # Undefined extension ops share one handler, so they are told apart
+        # by their operand.
+        opcode = VirtualMachine._opcodes.get(handler, 0xF00 | operand)
+        self._opcodes[opcode] = self._opcodes.get(opcode, 0) + 1
+        if handler is VirtualMachine._op_scall:
+            self._services[operand] += 1
+        elif handler is VirtualMachine._op_jmpf:
+            if operand <= pc and vm.get_reg(Register.PC) == operand:
+                key = (operand, pc)
+                self._loops[key] = self._loops.get(key, 0) + 1
+        elif handler is VirtualMachine._ex_op_call:
+            if len(self._stack) == MAX_CALL_DEPTH:
+                del self._stack[0]
+            self._stack.append((operand, self._clock))
+        elif handler is VirtualMachine._ex_op_ret and self._stack:
+            target, entry = self._stack.pop()
+            stats = self._calls.setdefault(target, [0, 0])
+            stats[0] += 1
+            stats[1] += vm.clock - entry
+
+    def heat_map(self, levels: int = 8) -> list[int]:
+        scale = math.log1p(max(self.pc_hits))
+        if scale == 0:
+            return [0] * 0x100
+        return [math.ceil(levels * math.log1p(n) / scale) for n in self.pc_hits]
+
+    def profile(self) -> Profile:
+        opcodes = {}
+        for opcode, n in self._opcodes.items():
+            name = _opcode_name(opcode)
+            opcodes[name] = opcodes.get(name, 0) + n
+        instructions = {}
+        for pc, inst in enumerate(self._insts):
+            if inst is not None:
+                handler, operand, _ = inst
+                opcode = VirtualMachine._opcodes.get(handler, 0xF00 | operand)
+                instructions[pc] = format_inst(opcode, operand)
+        calls = sorted(
+            (
+                CallStats(target, n, cycles)
+                for target, (n, cycles) in self._calls.items()
+            ),
+            key=lambda call: -call.cycles,
+        )
+        loops = sorted(
+            (
+                LoopStats(begin, end, n, sum(self.pc_hits[begin : end + 1]))
+                for (begin, end), n in self._loops.items()
+            ),
+            key=lambda loop: -loop.iterations,
+        )
+        return Profile(
+            self._cycles,
+            self.wait_cycles,
+            tuple(self.pc_hits),
+            instructions,
+            opcodes,
+            {_service_name(srv): n for srv, n in enumerate(self._services) if n},
+            calls,
+            loops,
+        )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-i", "--input", required=True)
+    parser.add_argument("-n", "--cycles", type=int, default=1_000_000)
+    parser.add_argument("-k", "--keys", type=lambda s: int(s, 16), nargs="*")
+    parser.add_argument("--skip-waits", action="store_true")
+    parser.add_argument("--top", type=int, default=10)
+    parser.add_argument("--json", action="store_true")
+    args = parser.parse_args()
+
+    vm = VirtualMachine(load_program(args.input))
+    for key in args.keys or []:
+        vm.prese_key(key)
+    profiler = Profiler()
+    profiler.attach(vm)
+    vm.run(args.cycles, args.skip_waits)
+    profiler.detach(vm)
+
+    profile = profiler.profile()
+    if args.json:
+        print(json.dumps(profile.to_dict()))
+    else:
+        print(profile.format(args.top))
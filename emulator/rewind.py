@@ -0,0 +1,120 @@
+from collections import deque
+
+from virtual_machine import VirtualMachine, VMState, changed_addrs
+
+
+class _Segment:
+    def __init__(self, keyframe: VMState):
+        self.keyframe = keyframe
+        self.deltas = bytearray()
+        self.cycles = 0
+        # The clock at the start of the newest cycle.
+        self.clock = keyframe.clock - 1
+
+
+class RewindBuffer:
+    # Each cycle is stored as an undo record: (address, old nibble) byte pairs
+    # for every nibble the cycle changed, then a trailer byte holding the pair
+    # count. Bit 7 of the trailer is set when the cycle started other than one
+    # tick after the previous one, in which case a 64-bit clock step
+    # precedes it. Steps are measured between cycle starts, so the clock is
+    # restored exactly even when it moved between cycles, as it does when
+    # the monitor skips a wait or parks. Records are read back from the end,
+    # so no per-cycle index is kept.
+    #
+    # A keyframe starts a new segment every keyframe_interval cycles and whole
+    # segments are evicted oldest first to stay within max_bytes.
+
+    KEYFRAME_SIZE = 0x100 + 64
+
+    def __init__(
+        self, max_bytes: int = 64 * 1024 * 1024, keyframe_interval: int = 4096
+    ):
+        assert keyframe_interval > 0
+        self.max_bytes = max_bytes
+        self.keyframe_interval = keyframe_interval
+        self._segments: deque[_Segment] = deque()
+        self._size = 0
+        self._before = b""
+        self._clock = 0
+
+    def __len__(self) -> int:
+        return sum(segment.cycles for segment in self._segments)
+
+    @property
+    def size(self) -> int:
+        return self._size
+
+    def attach(self, vm: VirtualMachine) -> None:
+        vm.add_observer(self)
+
+    def detach(self, vm: VirtualMachine) -> None:
+        vm.remove_observer(self)
+
+    def clear(self) -> None:
+        self._segments.clear()
+        self._size = 0
+
+    def before_cycle(self, vm: VirtualMachine) -> None:
+        self._before = bytes(vm.mem)
+        self._clock = vm.clock
+        if not self._segments or self._segments[-1].cycles >= self.keyframe_interval:
+            self._segments.append(_Segment(vm.snapshot()))
+            self._size += self.KEYFRAME_SIZE
+            self._evict()
+
+    def after_cycle(self, vm: VirtualMachine) -> None:
+        before = self._before
+        record = bytearray()
+        count = 0
+        for addr in changed_addrs(before, vm.mem):
+            record += bytes((addr, before[addr]))
+            count += 1
+        segment = self._segments[-1]
+        step = self._clock - segment.clock
+        if step != 1:
+            record += step.to_bytes(8, "little")
+            count |= 0x80
+        record.append(count)
+        segment.deltas += record
+        segment.cycles += 1
+        segment.clock = self._clock
+        self._size += len(record)
+
+    def step_back(self, vm: VirtualMachine, cycles: int = 1) -> int:
+        stepped = 0
+        while stepped < cycles and self._segments:
+            segment = self._segments[-1]
+            if segment.cycles <= cycles - stepped:
+                vm.restore(segment.keyframe)
+                stepped += segment.cycles
+                self._segments.pop()
+                self._size -= self.KEYFRAME_SIZE + len(segment.deltas)
+                continue
+            self._undo(vm, segment)
+            stepped += 1
+        return stepped
+
+    def _undo(self, vm: VirtualMachine, segment: _Segment) -> None:
+        deltas = segment.deltas
+        end = len(deltas) - 1
+        count = deltas[end]
+        step = 1
+        if count & 0x80:
+            count &= 0x7F
+            end -= 8
+            step = int.from_bytes(deltas[end : end + 8], "little")
+        begin = end - count * 2
+        for i in range(begin, end, 2):
+            vm.set_mem(deltas[i], deltas[i + 1])
+        self._size -= len(deltas) - begin
+        del deltas[begin:]
+        segment.cycles -= 1
+        vm.clock = segment.clock
+        segment.clock -= step
+        vm.halted = False
+
+    def _evict(self) -> None:
+        while self._size > self.max_bytes and len(self._segments) > 1:
+            segment = self._segments.popleft()
+            self._size -= self.KEYFRAME_SIZE + len(segment.deltas)
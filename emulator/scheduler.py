@@ -0,0 +1,92 @@
+import time
+
+
+class Scheduler:
+    # Paces bursts of cycles against a monotonic deadline. The clock value due
+    # now is worked out from a fixed anchor, so time lost to Python overhead
+    # or a late wake-up is made up by the next burst instead of adding up as
+    # drift, and cycles skipped by WAIT simply put the VM ahead of the
+    # deadline until real time catches up. Falling behind by more than
+    # MAX_LAG, e.g. after the host was suspended, re-anchors rather than
+    # racing to catch up.
+    #
+    # A speed of None is turbo: nothing is slept and bursts are sized to take
+    # about one frame of wall time.
+
+    MAX_LAG = 0.25
+    WINDOW = 0.5
+
+    def __init__(self, hz: int, speed: float | None = 1.0, frame_rate: int = 60):
+        self.frame = 1 / frame_rate
+        self.achieved_hz = 0.0
+        self._clock = 0
+        self.set_rate(hz, speed)
+
+    @property
+    def target_hz(self) -> float | None:
+        if self.speed is None:
+            return None
+        return self.hz * self.speed
+
+    def set_rate(self, hz: int, speed: float | None) -> None:
+        assert hz > 0
+        assert speed is None or speed > 0
+        self.hz = hz
+        self.speed = speed
+        self._burst = max(int(hz * self.frame), 1)
+        self.start(self._clock)
+
+    def start(self, clock: int) -> None:
+        now = time.monotonic()
+        self._anchor(now, clock)
+        self._window_time = now
+        self._window_clock = clock
+
+    def resync(self, clock: int) -> None:
+        self._anchor(time.monotonic(), clock)
+
+    def target(self, clock: int) -> int:
+        # The clock value the next burst should run up to.
+        now = time.monotonic()
+        self._clock = clock
+        self._burst_time = now
+        self._burst_clock = clock
+        if now - self._window_time >= self.WINDOW:
+            self.achieved_hz = (clock - self._window_clock) / (now - self._window_time)
+            self._window_time = now
+            self._window_clock = clock
+        if self.speed is None:
+            return clock + self._burst
+        rate = self.hz * self.speed
+        due = self._anchor_clock + int((now - self._anchor_time) * rate)
+        if due - clock > self.MAX_LAG * rate:
+            self._anchor(now - self.frame, clock)
+            due = clock + int(self.frame * rate)
+        return due
+
+    def delay(self, clock: int) -> float:
+        # How long to sleep after a burst that ended at clock: until the next
+        # cycle is due, but at least the rest of the frame and at most a whole
+        # frame, so commands and STOP are still picked up promptly.
+        now = time.monotonic()
+        self._clock = clock
+        if self.speed is None:
+            elapsed = now - self._burst_time
+            if elapsed > 0:
+                cycles = clock - self._burst_clock
+                self._burst = max(int(cycles * self.frame / elapsed), 1)
+            return 0
+        rate = self.hz * self.speed
+        due = self._anchor_time + (clock + 1 - self._anchor_clock) / rate
+        rest = self._burst_time + self.frame - now
+        return min(max(due - now, rest, 0), self.frame)
+
+    def cycles_for(self, seconds: float) -> int:
+        return int(seconds * (self.target_hz or self.hz))
+
+    def _anchor(self, now: float, clock: int) -> None:
+        self._anchor_time = now
+        self._anchor_clock = clock
+        self._clock = clock
+        self._burst_time = now
+        self._burst_clock = clock
@@ -0,0 +1,131 @@
+import argparse
+import mmap
+import struct
+from typing import Iterator, NamedTuple
+
+from virtual_machine import VirtualMachine, Register, format_inst
+
+
+MAGIC = b"OR4T"
+VERSION = 1
+HEADER = struct.Struct("<4sBB")
+RECORD = struct.Struct("<QBHBB3x")
+
+
+class TraceRecord(NamedTuple):
+    clock: int
+    pc: int
+    opcode: int
+    operand: int
+    flag: int
+
+
+class TraceRecorder:
+    def __init__(self, path: str, capacity: int = 0x10000):
+        self.path = path
+        self.capacity = capacity
+        self._buffer = bytearray(RECORD.size * capacity)
+        self._count = 0
+        self._pc = 0
+        self._waiting = False
+        self._file = open(path, "w+b")
+        self._file.write(HEADER.pack(MAGIC, VERSION, RECORD.size))
+        self._size = HEADER.size
+
+    def attach(self, vm: VirtualMachine) -> None:
+        vm.add_observer(self)
+
+    def detach(self, vm: VirtualMachine) -> None:
+        vm.remove_observer(self)
+        self.flush()
+
+    def close(self) -> None:
+        self.flush()
+        self._file.close()
+
+    def before_cycle(self, vm: VirtualMachine) -> None:
+        mem = vm.mem
+        self._waiting = vm.waiting
+        self._pc = (mem[Register.PC] << 4) | mem[Register.PC + 1]
+
+    def after_cycle(self, vm: VirtualMachine) -> None:
+        if self._waiting:
+            return
+        handler, operand, _ = vm._last
+        RECORD.pack_into(
+            self._buffer,
+            self._count * RECORD.size,
+            vm.clock,
+            self._pc,
+            vm._opcodes.get(handler, 0xF00 | operand),
+            operand,
+            (vm.mem[Register.F] >> 3) & 0x1,
+        )
+        self._count += 1
+        if self._count == self.capacity:
+            self.flush()
+
+    def flush(self) -> None:
+        if self._count == 0:
+            return
+        length = self._count * RECORD.size
+        self._file.truncate(self._size + length)
+        with mmap.mmap(self._file.fileno(), self._size + length) as mapped:
+            mapped[self._size : self._size + length] = self._buffer[:length]
+        self._size += length
+        self._count = 0
+
+
+class TraceReader:
+    def __init__(self, path: str):
+        self._file = open(path, "rb")
+        self._mapped = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, size = HEADER.unpack_from(self._mapped)
+        if magic != MAGIC:
+            raise ValueError("not an ORANGE-4 trace file")
+        if version != VERSION or size != RECORD.size:
+            raise ValueError(f"unsupported trace version: {version}")
+
+    def __enter__(self) -> "TraceReader":
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.close()
+
+    def __len__(self) -> int:
+        return (len(self._mapped) - HEADER.size) // RECORD.size
+
+    def __getitem__(self, index: int) -> TraceRecord:
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError(index)
+        return TraceRecord(
+            *RECORD.unpack_from(self._mapped, HEADER.size + index * RECORD.size)
+        )
+
+    def __iter__(self) -> Iterator[TraceRecord]:
+        for index in range(len(self)):
+            yield self[index]
+
+    def close(self) -> None:
+        self._mapped.close()
+        self._file.close()
+
+
+def format_record(record: TraceRecord) -> str:
+    inst = format_inst(record.opcode, record.operand)
+    return f"{record.clock:>10} {record.pc:02X}: {inst:<12} F={record.flag}"
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-i", "--input", required=True)
+    parser.add_argument("--start", type=int, default=0)
+    parser.add_argument("--count", type=int)
+    args = parser.parse_args()
+
+    with TraceReader(args.input) as reader:
+        end = len(reader) if args.count is None else args.start + args.count
+        for index in range(args.start, min(end, len(reader))):
+            print(format_record(reader[index]))
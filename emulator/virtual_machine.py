@@ -1,4 +1,10 @@
+import struct
+import time
+from dataclasses import dataclass
 from enum import IntEnum
+from typing import Callable
+
+from events import EventBus, EventKind, Beep, Io
 
 
 class MemoryLayout(IntEnum):
@@ -91,17 +97,203 @@ class ServiceCall(IntEnum):
     DECIMAL_ADD = 0xF
 
 
+class StopReason(IntEnum):
+    BUDGET = 0
+    HALT = 1
+    PREDICATE = 2
+    TIMEOUT = 3
+    BREAK = 4
+    CYCLE = 5
+
+
+class BreakpointHit(Exception):
+    pass
+
+
+@dataclass(frozen=True)
+class RunResult:
+    cycles: int
+    reason: StopReason
+    pc: int
+
+
+@dataclass(frozen=True, slots=True)
+class VMState:
+    MAGIC = b"OR4S"
+    VERSION = 1
+    _HEADER = struct.Struct("<4sBQ?H")
+
+    mem: bytes
+    clock: int = 0
+    halted: bool = False
+    last_inst: str = ""
+
+    def to_bytes(self) -> bytes:
+        last_inst = self.last_inst.encode()
+        header = self._HEADER.pack(
+            self.MAGIC, self.VERSION, self.clock, self.halted, len(last_inst)
+        )
+        packed = bytes(
+            (self.mem[i] << 4) | self.mem[i + 1] for i in range(0, 0x100, 2)
+        )
+        return header + last_inst + packed
+
+    @classmethod
+    def from_bytes(cls, raw: bytes) -> "VMState":
+        if len(raw) < cls._HEADER.size:
+            raise ValueError("truncated state header")
+        magic, version, clock, halted, size = cls._HEADER.unpack_from(raw)
+        if magic != cls.MAGIC:
+            raise ValueError("not an ORANGE-4 state file")
+        if version != cls.VERSION:
+            raise ValueError(f"unsupported state version: {version}")
+        offset = cls._HEADER.size
+        last_inst = raw[offset : offset + size].decode()
+        packed = raw[offset + size :]
+        if len(packed) != 0x80:
+            raise ValueError("state memory must be 0x80 bytes")
+        mem = bytearray(0x100)
+        mem[0::2] = bytes(byte >> 4 for byte in packed)
+        mem[1::2] = bytes(byte & 0xF for byte in packed)
+        return cls(bytes(mem), clock, halted, last_inst)
+
+    def save(self, path: str) -> None:
+        with open(path, "wb") as f:
+            f.write(self.to_bytes())
+
+    @classmethod
+    def load(cls, path: str) -> "VMState":
+        with open(path, "rb") as f:
+            return cls.from_bytes(f.read())
+
+
+_EXTENSIONS = {opcode for opcode in Opcode if opcode > Opcode.JMPF}
+
+
+def changed_addrs(before: bytes, after: bytes) -> list[int]:
+    changed = int.from_bytes(before, "little") ^ int.from_bytes(after, "little")
+    addrs = []
+    while changed:
+        addr = ((changed & -changed).bit_length() - 1) >> 3
+        addrs.append(addr)
+        changed &= ~(0xFF << (addr << 3))
+    return addrs
+
+
+def format_inst(opcode: int, operand: int) -> str:
+    if opcode <= Opcode.JMPF:
+        name = Opcode(opcode).name.lower()
+        if opcode < Opcode.LDI:
+            return name
+        return f"{name} 0x{operand:x}"
+    if opcode == Opcode.CALL:
+        return f"call 0x{operand:x}"
+    if opcode in _EXTENSIONS:
+        return Opcode(opcode).name.lower()
+    return f"jmpf 0x{opcode & 0xFF:x}"
+
+
 class VirtualMachine:
     HZ = 1000
+    # The longest WAIT, 1.6 s, has to fit the 16-bit wait counter.
+    MAX_HZ = 0xFFFF * 10 // 16
 
-    def __init__(self, data: list[int]):
-        assert len(data) == 0x80
-        self.data = data
+    def __init__(self, data: bytes | list[int]):
+        self.mem = bytearray(0x100)
+        self._decoded = [None] * 0x100
+        self.load(data)
         self.last_inst = ""
+        self.halted = False
+        self.clock = 0
+        self._wait_limit = 0
+        self._observers = []
+        self.events = EventBus()
+        self.reset_idle()
         self.set_reg(Register.SP, 0xFF)
 
+    @classmethod
+    def from_state(cls, state: VMState) -> "VirtualMachine":
+        vm = cls.__new__(cls)
+        vm.mem = bytearray(state.mem)
+        vm._decoded = [None] * 0x100
+        vm.last_inst = state.last_inst
+        vm.halted = state.halted
+        vm.clock = state.clock
+        vm._wait_limit = 0
+        vm._observers = []
+        vm.events = EventBus()
+        vm.reset_idle()
+        return vm
+
+    def snapshot(self) -> VMState:
+        return VMState(bytes(self.mem), self.clock, self.halted, self.last_inst)
+
+    def restore(self, state: VMState) -> None:
+        if self.mem[: MemoryLayout.PROGRAM_END + 1] != state.mem[
+            : MemoryLayout.PROGRAM_END + 1
+        ]:
+            self._decoded = [None] * 0x100
+        self.mem[:] = state.mem
+        self.last_inst = state.last_inst
+        self.halted = state.halted
+        self.clock = state.clock
+        self.reset_idle()
+
+    def fork(self) -> "VirtualMachine":
+        vm = type(self).__new__(type(self))
+        vm.mem = bytearray(self.mem)
+        vm._decoded = self._decoded.copy()
+        vm._last = self._last
+        vm._last_text = self._last_text
+        vm.halted = self.halted
+        vm.clock = self.clock
+        vm.HZ = self.HZ
+        vm._wait_limit = 0
+        vm._observers = []
+        vm.events = EventBus(self.events.capacity)
+        vm.idle_period = self.idle_period
+        vm._ink_state = self._ink_state
+        vm._ink_clock = self._ink_clock
+        vm._ink_events = vm.events.head - (self.events.head - self._ink_events)
+        return vm
+
+    @property
+    def data(self) -> bytes:
+        return self.pack()
+
+    @property
+    def last_inst(self) -> str:
+        if self._last is None:
+            return self._last_text
+        handler, operand, _ = self._last
+        return format_inst(self._opcodes.get(handler, 0xF00 | operand), operand)
+
+    @last_inst.setter
+    def last_inst(self, value: str) -> None:
+        self._last = None
+        self._last_text = value
+
+    def load(self, data: bytes | list[int]) -> None:
+        # Either a packed 0x80-byte image or the 0x100 nibbles themselves.
+        mem = self.mem
+        if len(data) == 0x100:
+            assert max(data) <= 0xF
+            mem[:] = bytes(data)
+        else:
+            assert len(data) == 0x80
+            for i, byte in enumerate(data):
+                mem[i * 2] = (byte >> 4) & 0xF
+                mem[i * 2 + 1] = byte & 0xF
+        self._decoded = [None] * 0x100
+        self.reset_idle()
+
+    def pack(self) -> bytes:
+        mem = self.mem
+        return bytes((mem[i] << 4) | mem[i + 1] for i in range(0, 0x100, 2))
+
     def prese_key(self, key: int) -> None:
         assert 0x0 <= key <= 0xF
+        self.reset_idle()
         if key <= 0x3:
             self.set_mem(
                 SystemLayout.KEY_STATE_BEGIN + 0,
@@ -171,6 +363,8 @@ class VirtualMachine:
 
     def set_numeric_led(self, value: int) -> None:
         assert 0x0 <= value <= 0xF
+        if self.mem[SystemLayout.NUMERIC_LED] != value:
+            self.events.emit(EventKind.NUMERIC_LED, self.clock, value)
         self.set_mem(SystemLayout.NUMERIC_LED, value)
 
     def get_binary_led(self) -> int:
@@ -180,83 +374,206 @@ class VirtualMachine:
 
     def set_binary_led(self, value: int) -> None:
         assert 0x0 <= value <= 0x7F
+        mem = self.mem
+        old = mem[SystemLayout.BINARY_LED] | (mem[SystemLayout.BINARY_LED + 1] << 4)
+        if old != value:
+            self.events.emit(EventKind.BINARY_LED, self.clock, value)
         self.set_mem(SystemLayout.BINARY_LED, value & 0xF)
         self.set_mem(SystemLayout.BINARY_LED + 1, value >> 4)
 
+    def add_observer(self, observer) -> None:
+        self._observers.append(observer)
+        self.cycle = self._observed_cycle
+
+    def remove_observer(self, observer) -> None:
+        self._observers.remove(observer)
+        if not self._observers:
+            del self.cycle
+
+    @property
+    def observed(self) -> bool:
+        return bool(self._observers)
+
+    def _observed_cycle(self) -> None:
+        for observer in self._observers:
+            observer.before_cycle(self)
+        VirtualMachine.cycle(self)
+        for observer in self._observers:
+            observer.after_cycle(self)
+
     def cycle(self) -> None:
-        wait_count = self.get_wait_count()
-        if wait_count > 0:
-            self.set_wait_count(wait_count - 1)
+        mem = self.mem
+        if self.waiting:
+            self.skip_wait(max(self._wait_limit - self.clock, 1))
             return
-        opcode = self.get_mem(self.get_reg(Register.PC))
-        self._exec_op(opcode)
-        self._inc_reg(Register.PC)
+        self.clock += 1
+        pc = (mem[Register.PC] << 4) | mem[Register.PC + 1]
+        inst = self._decoded[pc]
+        if inst is None:
+            inst = self._decode(pc)
+        handler, operand, length = inst
+        next_pc = (pc + length) & 0xFF
+        mem[Register.PC] = next_pc >> 4
+        mem[Register.PC + 1] = next_pc & 0xF
+        self._last = inst
+        handler(self, operand)
+
+    def reset_idle(self) -> None:
+        self.idle_period = 0
+        self._ink_state = b""
+        self._ink_clock = 0
+        self._ink_events = 0
+
+    def skip_idle(self, cycles: int, period: int | None = None) -> int:
+        # Only whole periods, so the machine state is left exactly as it is.
+        period = period or self.idle_period
+        if period == 0:
+            return 0
+        skipped = cycles - cycles % period
+        self.clock += skipped
+        self._ink_clock += skipped
+        return skipped
+
+    def skip_wait(self, max_ticks: int | None = None) -> int:
+        wait_count = self.get_wait_count()
+        ticks = wait_count if max_ticks is None else min(wait_count, max_ticks)
+        self.set_wait_count(wait_count - ticks)
+        self.clock += ticks
+        return ticks
+
+    def run(self, max_cycles: int, skip_waits: bool = False) -> RunResult:
+        return self._run(max_cycles, None, max_cycles, None, skip_waits)
+
+    def run_until(
+        self,
+        predicate: Callable[["VirtualMachine"], bool],
+        max_cycles: int | None = None,
+        check_every: int = 1,
+        skip_waits: bool = False,
+    ) -> RunResult:
+        assert check_every > 0
+        return self._run(max_cycles, predicate, check_every, None, skip_waits)
+
+    def run_for(
+        self,
+        seconds: float,
+        max_cycles: int | None = None,
+        check_every: int = 1000,
+        skip_waits: bool = False,
+    ) -> RunResult:
+        assert check_every > 0
+        deadline = time.monotonic() + seconds
+        return self._run(max_cycles, None, check_every, deadline, skip_waits)
+
+    def _run(
+        self,
+        max_cycles: int | None,
+        predicate: Callable[["VirtualMachine"], bool] | None,
+        check_every: int,
+        deadline: float | None,
+        skip_waits: bool,
+    ) -> RunResult:
+        cycle = self.cycle
+        start = self.clock
+        end = None if max_cycles is None else start + max_cycles
+        self.halted = False
+        if predicate is not None and predicate(self):
+            return self._run_result(start, StopReason.PREDICATE)
+        try:
+            while end is None or self.clock < end:
+                target = self.clock + check_every
+                if end is not None:
+                    target = min(target, end)
+                if skip_waits:
+                    self._wait_limit = target
+                while self.clock < target:
+                    cycle()
+                    if self.halted:
+                        return self._run_result(start, StopReason.HALT)
+                if predicate is not None and predicate(self):
+                    return self._run_result(start, StopReason.PREDICATE)
+                if deadline is not None and time.monotonic() >= deadline:
+                    return self._run_result(start, StopReason.TIMEOUT)
+            return self._run_result(start, StopReason.BUDGET)
+        except BreakpointHit:
+            return self._run_result(start, StopReason.BREAK)
+        finally:
+            self._wait_limit = 0
+
+    def _run_result(self, start: int, reason: StopReason) -> RunResult:
+        return RunResult(self.clock - start, reason, self.get_reg(Register.PC))
 
     def get_reg(self, register: Register) -> int:
         assert SystemLayout.REGISTER_BEGIN <= register <= SystemLayout.REGISTER_END
-        match register:
-            case Register.PC:
-                return (self.get_mem(Register.PC) << 4) | self.get_mem(Register.PC + 1)
-            case Register.SP:
-                return (self.get_mem(Register.SP) << 4) | self.get_mem(Register.SP + 1)
-            case Register.F:
-                return (self.get_mem(Register.F) >> 3) & 0x1
-            case _:
-                return self.get_mem(register)
+        mem = self.mem
+        if register == Register.PC or register == Register.SP:
+            return (mem[register] << 4) | mem[register + 1]
+        if register == Register.F:
+            return (mem[register] >> 3) & 0x1
+        return mem[register]
 
     def set_reg(self, register: Register, value: int) -> None:
         assert SystemLayout.REGISTER_BEGIN <= register <= SystemLayout.REGISTER_END
-        match register:
-            case Register.PC:
-                if value < 0:
-                    value += 0xFF
-                assert value <= 0xFF
-                self.set_mem(Register.PC, value >> 4)
-                self.set_mem(Register.PC + 1, value & 0xF)
-            case Register.SP:
-                if value < 0:
-                    value += 0xFF
-                assert value <= 0xFF
-                self.set_mem(Register.SP, value >> 4)
-                self.set_mem(Register.SP + 1, value & 0xF)
-            case Register.F:
-                assert 0x0 <= value <= 0x1
-                self.set_mem(Register.F, value << 3)
-            case _:
-                if value < 0:
-                    value += 0xF
-                assert value <= 0xF
-                self.set_mem(register, value)
+        mem = self.mem
+        if register == Register.PC or register == Register.SP:
+            if value < 0:
+                value += 0xFF
+            assert value <= 0xFF
+            mem[register] = value >> 4
+            mem[register + 1] = value & 0xF
+        elif register == Register.F:
+            assert 0x0 <= value <= 0x1
+            mem[register] = value << 3
+        else:
+            if value < 0:
+                value += 0xF
+            assert value <= 0xF
+            mem[register] = value
 
     def get_mem(self, addr: int) -> int:
         assert 0x00 <= addr <= 0xFF
-        if addr % 2 == 0:
-            return (self.data[addr // 2] >> 4) & 0xF
-        else:
-            return self.data[addr // 2] & 0xF
+        return self.mem[addr]
 
     def set_mem(self, addr: int, value: int) -> None:
         assert 0x00 <= addr <= 0xFF
         assert 0x0 <= value <= 0xF
-        if addr % 2 == 0:
-            self.data[addr // 2] &= 0x0F
-            self.data[addr // 2] |= value << 4
-        else:
-            self.data[addr // 2] &= 0xF0
-            self.data[addr // 2] |= value
+        self.mem[addr] = value
+        if addr <= MemoryLayout.PROGRAM_END:
+            decoded = self._decoded
+            for begin in range(max(addr - 4, 0), addr + 1):
+                decoded[begin] = None
+
+    @property
+    def waiting(self) -> bool:
+        # True while a WAIT is counting down, without assembling the count.
+        mem = self.mem
+        return bool(
+            mem[SystemLayout.WAIT_COUNT]
+            or mem[SystemLayout.WAIT_COUNT + 1]
+            or mem[SystemLayout.WAIT_COUNT + 2]
+            or mem[SystemLayout.WAIT_COUNT + 3]
+        )
 
     def get_wait_count(self) -> int:
-        count = self.get_mem(SystemLayout.WAIT_COUNT)
-        count |= self.get_mem(SystemLayout.WAIT_COUNT + 1) << 0x4
-        count |= self.get_mem(SystemLayout.WAIT_COUNT + 2) << 0x8
-        count |= self.get_mem(SystemLayout.WAIT_COUNT + 3) << 0xC
-        return count
+        mem = self.mem
+        return (
+            mem[SystemLayout.WAIT_COUNT]
+            | (mem[SystemLayout.WAIT_COUNT + 1] << 0x4)
+            | (mem[SystemLayout.WAIT_COUNT + 2] << 0x8)
+            | (mem[SystemLayout.WAIT_COUNT + 3] << 0xC)
+        )
+
+    def set_hz(self, hz: int) -> None:
+        # WAIT counts in cycles of this clock, from the next WAIT on.
+        assert 0 < hz <= self.MAX_HZ
+        self.HZ = hz
 
     def set_wait_count(self, wait_count: int) -> None:
-        self.set_mem(SystemLayout.WAIT_COUNT + 0, (wait_count >> 0x0) & 0xF)
-        self.set_mem(SystemLayout.WAIT_COUNT + 1, (wait_count >> 0x4) & 0xF)
-        self.set_mem(SystemLayout.WAIT_COUNT + 2, (wait_count >> 0x8) & 0xF)
-        self.set_mem(SystemLayout.WAIT_COUNT + 3, (wait_count >> 0xC) & 0xF)
+        mem = self.mem
+        mem[SystemLayout.WAIT_COUNT + 0] = (wait_count >> 0x0) & 0xF
+        mem[SystemLayout.WAIT_COUNT + 1] = (wait_count >> 0x4) & 0xF
+        mem[SystemLayout.WAIT_COUNT + 2] = (wait_count >> 0x8) & 0xF
+        mem[SystemLayout.WAIT_COUNT + 3] = (wait_count >> 0xC) & 0xF
 
     def _inc_reg(self, register: Register) -> None:
         self.set_reg(register, (self.get_reg(register) + 1) & 0xFF)
@@ -280,114 +597,151 @@ class VirtualMachine:
         self.set_reg(register, self.get_mem(self.get_reg(Register.SP) + 1))
         self._inc_reg(Register.SP)
 
-    def _exec_op(self, opcode: Opcode) -> None:
-        assert Opcode.INK <= opcode <= Opcode.JMPF
-        match opcode:
-            case Opcode.INK:
-                self._op_ink()
-            case Opcode.OUTN:
-                self._op_outn()
-            case Opcode.ABYZ:
-                self._op_abyz()
-            case Opcode.AY:
-                self._op_ay()
-            case Opcode.ST:
-                self._op_st()
-            case Opcode.LD:
-                self._op_ld()
-            case Opcode.ADD:
-                self._op_add()
-            case Opcode.SUB:
-                self._op_sub()
-            case Opcode.LDI:
-                self._op_ldi()
-            case Opcode.ADDI:
-                self._op_addi()
-            case Opcode.LDYI:
-                self._op_ldyi()
-            case Opcode.ADDYI:
-                self._op_addyi()
-            case Opcode.CPI:
-                self._op_cpi()
-            case Opcode.CPYI:
-                self._op_cpyi()
-            case Opcode.SCALL:
-                self._op_scall()
-            case Opcode.JMPF:
-                self._op_jmpf()
-
-    def _exec_ex_op(self, opcode: Opcode) -> None:
-        assert Opcode.CALL <= opcode <= Opcode.IN
-        match opcode:
-            case Opcode.CALL:
-                self._ex_op_call()
-            case Opcode.RET:
-                self._ex_op_ret()
-            case Opcode.PUSHA:
-                self._ex_op_pusha()
-            case Opcode.POPA:
-                self._ex_op_popa()
-            case Opcode.PUSHB:
-                self._ex_op_pushb()
-            case Opcode.PUSHY:
-                self._ex_op_pushy()
-            case Opcode.POPY:
-                self._ex_op_popy()
-            case Opcode.PUSHZ:
-                self._ex_op_pushz()
-            case Opcode.POPZ:
-                self._ex_op_popz()
-            case Opcode.IOCTRL:
-                self._ex_op_ioctrl()
-            case Opcode.OUT:
-                self._ex_op_out()
-            case Opcode.IN:
-                self._ex_op_in()
-
-    def _op_ink(self) -> None:
-        self.last_inst = "ink"
-        for key in range(0x10):
-            if self.get_key_state(key):
-                self.set_reg(Register.A, key)
+    @classmethod
+    def _build_dispatch_tables(cls) -> None:
+        cls._ops = [
+            cls._op_ink,
+            cls._op_outn,
+            cls._op_abyz,
+            cls._op_ay,
+            cls._op_st,
+            cls._op_ld,
+            cls._op_add,
+            cls._op_sub,
+            cls._op_ldi,
+            cls._op_addi,
+            cls._op_ldyi,
+            cls._op_addyi,
+            cls._op_cpi,
+            cls._op_cpyi,
+            cls._op_scall,
+            cls._op_jmpf,
+        ]
+
+        cls._ex_ops = [None] * 0x100
+        for addr in range(MemoryLayout.SYSTEM_BEGIN, MemoryLayout.STACK_BEGIN):
+            cls._ex_ops[addr] = cls._ex_op_undefined
+        for opcode, handler in (
+            (Opcode.CALL, cls._ex_op_call),
+            (Opcode.RET, cls._ex_op_ret),
+            (Opcode.PUSHA, cls._ex_op_pusha),
+            (Opcode.POPA, cls._ex_op_popa),
+            (Opcode.PUSHB, cls._ex_op_pushb),
+            (Opcode.POPB, cls._ex_op_popb),
+            (Opcode.PUSHY, cls._ex_op_pushy),
+            (Opcode.POPY, cls._ex_op_popy),
+            (Opcode.PUSHZ, cls._ex_op_pushz),
+            (Opcode.POPZ, cls._ex_op_popz),
+            (Opcode.IOCTRL, cls._ex_op_ioctrl),
+            (Opcode.OUT, cls._ex_op_out),
+            (Opcode.IN, cls._ex_op_in),
+        ):
+            cls._ex_ops[opcode & 0xFF] = handler
+
+        cls._srvs = [cls._srv_undefined] * 0x10
+        for srv, handler in (
+            (ServiceCall.TURN_OFF_NUMERIC_LED, cls._srv_turn_off_numeric_led),
+            (ServiceCall.TURN_ON_REGISTER, cls._srv_turn_on_register),
+            (ServiceCall.TURN_OFF_REGISTER, cls._srv_turn_off_register),
+            (ServiceCall.INVERT_ALL_BITS, cls._srv_invert_all_bits),
+            (ServiceCall.SWAP_AUX_REGISTERS, cls._srv_swap_aux_registers),
+            (ServiceCall.RIGHT_SHIFT, cls._srv_right_shift),
+            (ServiceCall.BEEP_END_SE, cls._srv_beep_end_se),
+            (ServiceCall.BEEP_ERROR_SE, cls._srv_beep_error_se),
+            (ServiceCall.BEEP_LONG_SE, cls._srv_beep_long_se),
+            (ServiceCall.BEEP_SHORT_SE, cls._srv_beep_short_se),
+            (ServiceCall.BEEP_SOUND_SCALE, cls._srv_beep_sound_scale),
+            (ServiceCall.WAIT, cls._srv_wait),
+            (ServiceCall.TURN_ON_MEMORY, cls._srv_turn_on_memory),
+            (ServiceCall.DECIMAL_SUB, cls._srv_decimal_sub),
+            (ServiceCall.DECIMAL_ADD, cls._srv_decimal_add),
+        ):
+            cls._srvs[srv] = handler
+
+        cls._opcodes = {handler: opcode for opcode, handler in enumerate(cls._ops)}
+        cls._opcodes[cls._op_jmpf_self] = Opcode.JMPF
+        for addr, handler in enumerate(cls._ex_ops):
+            if handler is not None and handler is not cls._ex_op_undefined:
+                cls._opcodes[handler] = 0xF00 | addr
+
+    def _decode(self, pc: int) -> tuple:
+        mem = self.mem
+        opcode = mem[pc]
+        if opcode < Opcode.LDI:
+            inst = (self._ops[opcode], 0, 1)
+        elif opcode < Opcode.JMPF:
+            inst = (self._ops[opcode], mem[(pc + 1) & 0xFF], 2)
+        else:
+            addr = (mem[(pc + 1) & 0xFF] << 4) | mem[(pc + 2) & 0xFF]
+            ex_op = self._ex_ops[addr]
+            if ex_op is None and addr == pc:
+                inst = (VirtualMachine._op_jmpf_self, addr, 3)
+            elif ex_op is None:
+                inst = (VirtualMachine._op_jmpf, addr, 3)
+            elif addr == Opcode.CALL & 0xFF:
+                addr = (mem[(pc + 3) & 0xFF] << 4) | mem[(pc + 4) & 0xFF]
+                inst = (ex_op, addr, 5)
+            else:
+                inst = (ex_op, addr, 3)
+        if pc + inst[2] - 1 <= MemoryLayout.PROGRAM_END:
+            self._decoded[pc] = inst
+        return inst
+
+    def _op_ink(self, operand: int) -> None:
+        mem = self.mem
+        for i in range(4):
+            keys = mem[SystemLayout.KEY_STATE_BEGIN + i]
+            if keys:
+                self.set_reg(Register.A, i * 4 + ((keys & -keys).bit_length() - 1))
                 self.set_reg(Register.F, 0)
+                self._ink_state = b""
+                self.idle_period = 0
                 return
         self.set_reg(Register.F, 1)
+        # Reaching the same no-key INK in exactly the same state, without
+        # having emitted anything on the way, means the program will poll in
+        # this loop until a key is pressed.
+        state = bytes(mem)
+        head = self.events.head
+        if (
+            state == self._ink_state
+            and head == self._ink_events
+            and self.clock > self._ink_clock
+        ):
+            self.idle_period = self.clock - self._ink_clock
+        else:
+            self.idle_period = 0
+        self._ink_state = state
+        self._ink_clock = self.clock
+        self._ink_events = head
 
-    def _op_outn(self) -> None:
-        self.last_inst = "outn"
+    def _op_outn(self, operand: int) -> None:
         self.set_numeric_led(self.get_reg(Register.A))
         self.set_reg(Register.F, 1)
-        self.set_reg(Register.F, 1)
 
-    def _op_abyz(self) -> None:
-        self.last_inst = "abyz"
+    def _op_abyz(self, operand: int) -> None:
         self._swap_reg(Register.A, Register.B)
         self._swap_reg(Register.Y, Register.Z)
         self.set_reg(Register.F, 1)
 
-    def _op_ay(self) -> None:
-        self.last_inst = "ay"
+    def _op_ay(self, operand: int) -> None:
         self._swap_reg(Register.A, Register.Y)
         self.set_reg(Register.F, 1)
 
-    def _op_st(self) -> None:
-        self.last_inst = "st"
+    def _op_st(self, operand: int) -> None:
         self.set_mem(self.get_reg(Register.Y) + 50, self.get_reg(Register.A))
         self.set_reg(Register.F, 1)
 
-    def _op_ld(self) -> None:
-        self.last_inst = "ld"
+    def _op_ld(self, operand: int) -> None:
         self.set_reg(Register.A, self.get_mem(self.get_reg(Register.Y) + 50))
         self.set_reg(Register.F, 1)
 
-    def _op_add(self) -> None:
-        self.last_inst = "add"
+    def _op_add(self, operand: int) -> None:
         val = self.get_mem(self.get_reg(Register.Y) + 50) + self.get_reg(Register.A)
         self.set_reg(Register.A, val & 0xF)
         self.set_reg(Register.F, val >> 4)
 
-    def _op_sub(self) -> None:
-        self.last_inst = "sub"
+    def _op_sub(self, operand: int) -> None:
         val = self.get_mem(self.get_reg(Register.Y) + 50) - self.get_reg(Register.A)
         if val < 0:
             val += 0x10
@@ -396,209 +750,191 @@ class VirtualMachine:
             self.set_reg(Register.F, 0)
         self.set_reg(Register.A, val & 0xF)
 
-    def _op_ldi(self) -> None:
-        self._inc_reg(Register.PC)
-        val = self.get_mem(self.get_reg(Register.PC))
+    def _op_ldi(self, val: int) -> None:
         self.set_reg(Register.A, val)
         self.set_reg(Register.F, 1)
-        self.last_inst = f"ldi 0x{val:x}"
 
-    def _op_addi(self) -> None:
-        self._inc_reg(Register.PC)
-        add = self.get_mem(self.get_reg(Register.PC))
+    def _op_addi(self, add: int) -> None:
         val = self.get_reg(Register.A) + add
         self.set_reg(Register.A, val & 0xF)
         self.set_reg(Register.F, val >> 4)
-        self.last_inst = f"addi 0x{add:x}"
 
-    def _op_ldyi(self) -> None:
-        self._inc_reg(Register.PC)
-        val = self.get_mem(self.get_reg(Register.PC))
+    def _op_ldyi(self, val: int) -> None:
         self.set_reg(Register.Y, val)
         self.set_reg(Register.F, 1)
-        self.last_inst = f"ldyi 0x{val:x}"
 
-    def _op_addyi(self) -> None:
-        self._inc_reg(Register.PC)
-        add = self.get_mem(self.get_reg(Register.PC))
+    def _op_addyi(self, add: int) -> None:
         val = self.get_reg(Register.Y) + add
         self.set_reg(Register.Y, val & 0xF)
         self.set_reg(Register.F, val >> 4)
-        self.last_inst = f"addyi 0x{add:x}"
 
-    def _op_cpi(self) -> None:
-        self._inc_reg(Register.PC)
-        val = self.get_mem(self.get_reg(Register.PC))
+    def _op_cpi(self, val: int) -> None:
         if self.get_reg(Register.A) == val:
             self.set_reg(Register.F, 0)
         else:
             self.set_reg(Register.F, 1)
-        self.last_inst = f"cpi 0x{val:x}"
 
-    def _op_cpyi(self) -> None:
-        self._inc_reg(Register.PC)
-        val = self.get_mem(self.get_reg(Register.PC))
+    def _op_cpyi(self, val: int) -> None:
         if self.get_reg(Register.Y) == val:
             self.set_reg(Register.F, 0)
         else:
             self.set_reg(Register.F, 1)
-        self.last_inst = f"cpyi 0x{val:x}"
 
-    def _op_scall(self) -> None:
-        self._inc_reg(Register.PC)
-        val = self.get_mem(self.get_reg(Register.PC))
+    def _op_scall(self, val: int) -> None:
         self._scall(val)
-        self.last_inst = f"scall 0x{val:x}"
-
-    def _op_jmpf(self) -> None:
-        self._inc_reg(Register.PC)
-        addr_high = self.get_mem(self.get_reg(Register.PC))
-        self._inc_reg(Register.PC)
-        addr_low = self.get_mem(self.get_reg(Register.PC))
-        addr = (addr_high << 4) | addr_low
-        if addr < MemoryLayout.SYSTEM_BEGIN or addr >= MemoryLayout.STACK_BEGIN:
-            if self.get_reg(Register.F) == 0:
-                self.set_reg(Register.F, 1)
-            else:
-                self.set_reg(Register.PC, addr - 1)
-            self.last_inst = f"jmpf 0x{addr:x}"
+
+    def _op_jmpf(self, addr: int) -> None:
+        if self.get_reg(Register.F) == 0:
+            self.set_reg(Register.F, 1)
         else:
-            self._exec_ex_op(0xF00 | addr)
-
-    def _ex_op_call(self) -> None:
-        self._inc_reg(Register.PC)
-        addr_high = self.get_mem(self.get_reg(Register.PC))
-        self._inc_reg(Register.PC)
-        addr_low = self.get_mem(self.get_reg(Register.PC))
-        addr = (addr_high << 4) | addr_low
-        ret_addr = self.get_reg(Register.PC)
+            self.set_reg(Register.PC, addr)
+
+    def _op_jmpf_self(self, addr: int) -> None:
+        self._op_jmpf(addr)
+        self.halted = self.get_reg(Register.PC) == addr
+
+    def _ex_op_call(self, addr: int) -> None:
+        ret_addr = (self.get_reg(Register.PC) - 1) & 0xFF
         self._dec_reg(Register.SP)
         self._dec_reg(Register.SP)
         self.set_mem(self.get_reg(Register.SP) + 1, ret_addr >> 4)
         self.set_mem(self.get_reg(Register.SP) + 2, ret_addr & 0xF)
-        self.set_reg(Register.PC, addr - 1)
+        self.set_reg(Register.PC, addr)
         self.set_reg(Register.F, 1)
-        self.last_inst = f"call 0x{addr:x}"
 
-    def _ex_op_ret(self) -> None:
+    def _ex_op_ret(self, operand: int) -> None:
         ret_addr = (self.get_mem(self.get_reg(Register.SP) + 1) << 4) | self.get_mem(
             self.get_reg(Register.SP) + 2
         )
         self._inc_reg(Register.SP)
         self._inc_reg(Register.SP)
-        self.set_reg(Register.PC, ret_addr)
+        self.set_reg(Register.PC, (ret_addr + 1) & 0xFF)
         self.set_reg(Register.F, 1)
-        self.last_inst = "ret"
 
-    def _ex_op_pusha(self) -> None:
+    def _ex_op_pusha(self, operand: int) -> None:
         self._push_reg(Register.A)
         self.set_reg(Register.F, 1)
-        self.last_inst = "pusha"
 
-    def _ex_op_popa(self) -> None:
+    def _ex_op_popa(self, operand: int) -> None:
         self._pop_reg(Register.A)
         self.set_reg(Register.F, 1)
-        self.last_inst = "popa"
 
-    def _ex_op_pushb(self) -> None:
+    def _ex_op_pushb(self, operand: int) -> None:
         self._push_reg(Register.B)
         self.set_reg(Register.F, 1)
-        self.last_inst = "pushb"
 
-    def _ex_op_popb(self) -> None:
+    def _ex_op_popb(self, operand: int) -> None:
         self._pop_reg(Register.B)
         self.set_reg(Register.F, 1)
-        self.last_inst = "popb"
 
-    def _ex_op_pushy(self) -> None:
+    def _ex_op_pushy(self, operand: int) -> None:
         self._push_reg(Register.Y)
         self.set_reg(Register.F, 1)
-        self.last_inst = "pushy"
 
-    def _ex_op_popy(self) -> None:
+    def _ex_op_popy(self, operand: int) -> None:
         self._pop_reg(Register.Y)
         self.set_reg(Register.F, 1)
-        self.last_inst = "popy"
 
-    def _ex_op_pushz(self) -> None:
+    def _ex_op_pushz(self, operand: int) -> None:
         self._push_reg(Register.Z)
         self.set_reg(Register.F, 1)
-        self.last_inst = "pushz"
 
-    def _ex_op_popz(self) -> None:
+    def _ex_op_popz(self, operand: int) -> None:
         self._pop_reg(Register.Z)
         self.set_reg(Register.F, 1)
-        self.last_inst = "popz"
 
-    def _ex_op_ioctrl(self) -> None:
-        print("Unimpl: ioctrl")
+    def _ex_op_undefined(self, operand: int) -> None:
+        pass
+
+    def _ex_op_ioctrl(self, operand: int) -> None:
+        self.events.emit(EventKind.IO, self.clock, Io.IOCTRL, self.get_reg(Register.A))
         self.set_reg(Register.F, 1)
-        self.last_inst = "ioctrl"
 
-    def _ex_op_out(self) -> None:
-        print("Unimpl: out")
+    def _ex_op_out(self, operand: int) -> None:
+        self.events.emit(EventKind.IO, self.clock, Io.OUT, self.get_reg(Register.A))
         self.set_reg(Register.F, 1)
-        self.last_inst = "out"
 
-    def _ex_op_in(self) -> None:
-        print("Unimple: in")
+    def _ex_op_in(self, operand: int) -> None:
+        self.events.emit(EventKind.IO, self.clock, Io.IN, self.get_reg(Register.A))
         self.set_reg(Register.F, 1)
-        self.last_inst = "in"
 
     def _scall(self, srv: ServiceCall) -> None:
-        match srv:
-            case ServiceCall.TURN_OFF_NUMERIC_LED:
-                print("Unimpl srv: 0")
-                self.set_reg(Register.F, 1)
-            case ServiceCall.TURN_ON_REGISTER:
-                val = self.get_reg(Register.Y)
-                self.set_binary_led((self.get_binary_led() | (1 << val)) & 0x7F)
-                self.set_reg(Register.F, 1)
-            case ServiceCall.TURN_OFF_REGISTER:
-                val = self.get_reg(Register.Y)
-                self.set_binary_led((self.get_binary_led() & ~(1 << val)) & 0x7F)
-                self.set_reg(Register.F, 1)
-            case ServiceCall.INVERT_ALL_BITS:
-                self.set_reg(Register.A, (~self.get_reg(Register.A)) & 0xF)
-                self.set_reg(Register.F, 1)
-            case ServiceCall.SWAP_AUX_REGISTERS:
-                self._swap_reg(Register.A, Register.A2)
-                self._swap_reg(Register.B, Register.B2)
-                self._swap_reg(Register.Y, Register.Y2)
-                self._swap_reg(Register.Z, Register.Z2)
-                self.set_reg(Register.F, 1)
-            case ServiceCall.RIGHT_SHIFT:
-                val = self.get_reg(Register.A)
-                self.set_reg(Register.A, val >> 1)
-                self.set_reg(Register.F, val & 1)
-            case ServiceCall.BEEP_END_SE:
-                print("BEEP: END")
-                self.set_reg(Register.F, 1)
-            case ServiceCall.BEEP_ERROR_SE:
-                print("BEEP: ERROR")
-                self.set_reg(Register.F, 1)
-            case ServiceCall.BEEP_SHORT_SE:
-                print("BEEP: SHORT")
-                self.set_reg(Register.F, 1)
-            case ServiceCall.BEEP_LONG_SE:
-                print("BEEP: LONG")
-                self.set_reg(Register.F, 1)
-            case ServiceCall.BEEP_SOUND_SCALE:
-                val = self.get_reg(Register.A)
-                print(f"BEEP: {val:X}")
-                self.set_reg(Register.F, 1)
-            case ServiceCall.WAIT:
-                val = self.get_reg(Register.A) + 1
-                wait = val * self.HZ // 10
-                self.set_wait_count(wait)
-                self.set_reg(Register.F, 1)
-            case ServiceCall.TURN_ON_MEMORY:
-                val = self.get_mem(0x5E) | ((self.get_mem(0x5F) & 0x7) << 4)
-                self.set_binary_led((self.get_binary_led() | (1 << val)) & 0x7F)
-                self.set_reg(Register.F, 1)
-            case ServiceCall.DECIMAL_SUB:
-                print("Unimpl srv: E")
-                self.set_reg(Register.F, 1)
-            case ServiceCall.DECIMAL_ADD:
-                print("Umimpl srv F")
-                self.set_reg(Register.F, 1)
+        self._srvs[srv](self)
+
+    def _srv_undefined(self) -> None:
+        pass
+
+    def _srv_turn_off_numeric_led(self) -> None:
+        self.events.emit(
+            EventKind.UNIMPLEMENTED, self.clock, ServiceCall.TURN_OFF_NUMERIC_LED
+        )
+        self.set_reg(Register.F, 1)
+
+    def _srv_turn_on_register(self) -> None:
+        val = self.get_reg(Register.Y)
+        self.set_binary_led((self.get_binary_led() | (1 << val)) & 0x7F)
+        self.set_reg(Register.F, 1)
+
+    def _srv_turn_off_register(self) -> None:
+        val = self.get_reg(Register.Y)
+        self.set_binary_led((self.get_binary_led() & ~(1 << val)) & 0x7F)
+        self.set_reg(Register.F, 1)
+
+    def _srv_invert_all_bits(self) -> None:
+        self.set_reg(Register.A, (~self.get_reg(Register.A)) & 0xF)
+        self.set_reg(Register.F, 1)
+
+    def _srv_swap_aux_registers(self) -> None:
+        self._swap_reg(Register.A, Register.A2)
+        self._swap_reg(Register.B, Register.B2)
+        self._swap_reg(Register.Y, Register.Y2)
+        self._swap_reg(Register.Z, Register.Z2)
+        self.set_reg(Register.F, 1)
+
+    def _srv_right_shift(self) -> None:
+        val = self.get_reg(Register.A)
+        self.set_reg(Register.A, val >> 1)
+        self.set_reg(Register.F, val & 1)
+
+    def _srv_beep_end_se(self) -> None:
+        self.events.emit(EventKind.BEEP, self.clock, Beep.END)
+        self.set_reg(Register.F, 1)
+
+    def _srv_beep_error_se(self) -> None:
+        self.events.emit(EventKind.BEEP, self.clock, Beep.ERROR)
+        self.set_reg(Register.F, 1)
+
+    def _srv_beep_short_se(self) -> None:
+        self.events.emit(EventKind.BEEP, self.clock, Beep.SHORT)
+        self.set_reg(Register.F, 1)
+
+    def _srv_beep_long_se(self) -> None:
+        self.events.emit(EventKind.BEEP, self.clock, Beep.LONG)
+        self.set_reg(Register.F, 1)
+
+    def _srv_beep_sound_scale(self) -> None:
+        val = self.get_reg(Register.A)
+        self.events.emit(EventKind.BEEP, self.clock, Beep.SCALE, val)
+        self.set_reg(Register.F, 1)
+
+    def _srv_wait(self) -> None:
+        val = self.get_reg(Register.A) + 1
+        wait = val * self.HZ // 10
+        self.set_wait_count(wait)
+        self.set_reg(Register.F, 1)
+
+    def _srv_turn_on_memory(self) -> None:
+        val = self.get_mem(0x5E) | ((self.get_mem(0x5F) & 0x7) << 4)
+        self.set_binary_led((self.get_binary_led() | (1 << val)) & 0x7F)
+        self.set_reg(Register.F, 1)
+
+    def _srv_decimal_sub(self) -> None:
+        self.events.emit(EventKind.UNIMPLEMENTED, self.clock, ServiceCall.DECIMAL_SUB)
+        self.set_reg(Register.F, 1)
+
+    def _srv_decimal_add(self) -> None:
+        self.events.emit(EventKind.UNIMPLEMENTED, self.clock, ServiceCall.DECIMAL_ADD)
+        self.set_reg(Register.F, 1)
+
+
+VirtualMachine._build_dispatch_tables()
@@ -1,27 +1,31 @@
 import argparse
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "emulator"))
+
+from loader import ImageCache, load_hex, pack, convert_directory
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument("-i", "--input", required=True)
     parser.add_argument("-o", "--output", required=True)
+    parser.add_argument("--no-cache", action="store_true")
     args = parser.parse_args()
 
-    buffer = [0] * 0x100
+    cache = None if args.no_cache else ImageCache()
 
-    with open(args.input, "r") as f:
-        for line in f.readlines():
-            [addr, data] = line.split(":")
-            addr = int(addr[1:], 16)
-            for byte in data.rstrip():
-                buffer[addr] = int(byte, 16)
-                addr += 1
+    if os.path.isdir(args.input):
+        written, errors = convert_directory(args.input, args.output, cache)
+        for error in errors:
+            print(error, file=sys.stderr)
+        print(f"converted {len(written)} file(s), {len(errors)} failed")
+        sys.exit(1 if errors else 0)
 
-    memory = [0] * 0x80
-    for i, byte in enumerate(buffer):
-        if i % 2 == 0:
-            memory[i // 2] |= byte << 4
-        else:
-            memory[i // 2] |= byte
+    try:
+        image = pack(load_hex(args.input, cache))
+    except ValueError as e:
+        sys.exit(str(e))
 
     with open(args.output, "wb") as f:
-        f.write(bytes(memory))
+        f.write(image)